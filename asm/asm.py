@@ -13,9 +13,18 @@
 #  DB 0x0a   ; a hex byte
 #  DB 12   ; a decimal byte
 #  DB 0b0001 ; a binary byte
+#
+#  BANK 3   ; what follows goes in bank 3 of extended memory
 
 import sys
 import re
+import struct
+import collections
+import concurrent.futures
+import hashlib
+import io
+import os
+import tempfile
 
 # Opcodes
 OPCODES = {
@@ -57,18 +66,73 @@ OPCODES = {
 
 # Regex for matching lines
 # Capturing groups: label, opcode, operandA, operandB
-REGEX = r"(?:(\w+?):)?\s*(?:(\w+)\s*(?:(\w+)(?:\s*,\s*(\w+))?)?)?"
+REGEX = re.compile(r"(?:(\w+?):)?\s*(?:(\w+)\s*(?:(\w+)(?:\s*,\s*(\w+))?)?)?")
 
 # Regex for capturing DS and DB data
-REGEX_DS = r"(?:(\w+?):)?\s*DS\s*(.+)"  # insensitive
-REGEX_DB = r"(?:(\w+?):)?\s*DB\s*(.+)"  # insensitive
+REGEX_DS = re.compile(r"(?:(\w+?):)?\s*DS\s*(.+)", re.IGNORECASE)
+REGEX_DB = re.compile(r"(?:(\w+?):)?\s*DB\s*(.+)", re.IGNORECASE)
+
+# Regex for register operands
+REGEX_REG = re.compile(r"R([0-7])")
+
+# Binary image layout, shared with ls8/image.py:
+# header (magic, version, flags, symbol count, image length), the image, then
+# each symbol as name length, name and 16-bit address
+IMAGE_MAGIC = b"LS8I"
+IMAGE_VERSION = 1
+IMAGE_HEADER = struct.Struct("<4sBBHI")
+IMAGE_SYMBOL = struct.Struct("<H")
+
+# Extended memory, shared with ls8/devices.py: banks of BANK_SIZE bytes
+# show through the window at BANK_START. Images place bank N right after
+# the 256 bytes of RAM, at RAM_SIZE + N * BANK_SIZE.
+RAM_SIZE = 0x100
+BANK_START = 0x80
+BANK_SIZE = 0x40
+MAX_BANKS = 0x10000
+
+# Build mode caches outputs here, named by the hash of the source, the
+# options and this file
+CACHE_DIR = os.environ.get("ASM_CACHE",
+                           os.path.join(os.path.expanduser("~"), ".cache", "ls8", "asm"))
+
+# Build mode only starts a process pool for at least this many sources
+POOL_THRESHOLD = 32
+
+# Parsed program items. a and b are register numbers, except that LDI's b
+# is its immediate value or the name of a label. Data holds byte values and
+# the listing comment for each.
+Label = collections.namedtuple("Label", "name")
+Instruction = collections.namedtuple("Instruction", "opcode op_a op_b a b")
+Data = collections.namedtuple("Data", "values comments")
+Bank = collections.namedtuple("Bank", "number")
+
+# Laid out program: the memory image, (offset, label) for every byte that
+# gets a label's address, and for the .ls8 listing, the comment lines
+# before a byte and the comment after it, both by offset
+Layout = collections.namedtuple("Layout", "image fixups headings remarks")
+
+# Bytes taken by each opcode type
+TYPE_SIZES = {0: 1, 1: 2, 2: 3, 8: 3}
+
+# Instructions after which execution never falls through to the next one
+UNCONDITIONAL = ("HLT", "JMP", "RET", "IRET")
+CONDITIONAL = ("JEQ", "JNE", "JGT", "JLT", "JLE", "JGE")
+
+# Registers the optimizer never tracks: IM and IS change under interrupts
+# and devices, and SP under every stack operation
+VOLATILE_REGISTERS = (5, 6, 7)
 
 
 def parse_commandline(argv):
     """
-    Usage: asm.py [inputfile] [outputfile]
+    Usage: asm.py [--binary] [--optimize] [inputfile] [outputfile]
     """
 
+    binary = "--binary" in argv
+    optimized = "--optimize" in argv
+    argv = [a for a in argv if a not in ("--binary", "--optimize")]
+
     if len(argv) == 1:
         inputfile = "-"
         outputfile = "-"
@@ -82,16 +146,18 @@ def parse_commandline(argv):
         outputfile = argv[2]
 
     else:
-        print("usage: asm.py [infile.asm] [outfile.ls8]", file=sys.stderr)
+        print("usage: asm.py [--binary] [--optimize] [infile.asm] [outfile.ls8]",
+              file=sys.stderr)
         sys.exit(1)
 
-    return inputfile, outputfile
+    return inputfile, outputfile, binary, optimized
 
 
-def open_files(inputfile, outputfile):
+def open_files(inputfile, outputfile, binary=False):
     """
     Open files for reading and writing. If either of the files are named "-",
-    stdin or stdout is returned as appropriate.
+    stdin or stdout is returned as appropriate. The output is opened in
+    binary mode when writing a binary image.
     """
 
     if inputfile == "-":
@@ -100,9 +166,9 @@ def open_files(inputfile, outputfile):
         inputfile = open(inputfile)
 
     if outputfile == "-":
-        outputfile = sys.stdout
+        outputfile = sys.stdout.buffer if binary else sys.stdout
     else:
-        outputfile = open(outputfile, "w")
+        outputfile = open(outputfile, "wb" if binary else "w")
 
     return inputfile, outputfile
 
@@ -127,28 +193,23 @@ def p8(v):
     return "{:08b}".format(v)
 
 
-def pass1(inputfile, sym, code):
+def parse(inputfile):
     """
-    Pass 1
-
-    * Read the source code lines
-    * Parse labels, opcodes, and operands
-    * Record label offsets
-    * Emit machine code
+    Read the source code lines and parse labels, opcodes, and operands into
+    a list of Label, Instruction and Data items.
     """
 
+    program = []
+
     # Source line number
     line_num = 0
 
-    # Current code address (for labels)
-    addr = 0
-
     def get_reg(op, fatal=True):
         """Get a register number from a string, e.g. "R2" -> 2"""
 
         nonlocal line_num
 
-        m = re.match(r"R([0-7])", op)
+        m = REGEX_REG.match(op)
 
         if m is None:
             if fatal:
@@ -163,89 +224,64 @@ def pass1(inputfile, sym, code):
     def out0(opcode, op_a, op_b, machine_code):
         """Handle opcodes with zero operands"""
 
-        nonlocal addr
-
-        code.append(f"{machine_code} # {opcode}")
-        addr += 1
+        program.append(Instruction(opcode, op_a, op_b, None, None))
 
     def out1(opcode, op_a, op_b, machine_code):
         """Handle opcodes with one operand"""
 
-        nonlocal addr
-
         reg_a = get_reg(op_a)
-        code.append(f"{machine_code} # {opcode} {op_a}")
-        code.append(p8(reg_a))
-        addr += 2
+        program.append(Instruction(opcode, op_a, op_b, reg_a, None))
 
     def out2(opcode, op_a, op_b, machine_code):
         """Handle opcodes with two operands"""
 
-        nonlocal addr
-
         reg_a = get_reg(op_a)
         reg_b = get_reg(op_b)
 
-        code.append(f"{machine_code} # {opcode} {op_a},{op_b}")
-        code.append(p8(reg_a))
-        code.append(p8(reg_b))
-
-        addr += 3
+        program.append(Instruction(opcode, op_a, op_b, reg_a, reg_b))
 
     def out8(opcode, op_a, op_b, machine_code):
         """Handle LDI opcode (type 8)"""
 
-        nonlocal addr
-
         reg_a = get_reg(op_a)
 
         try:
             val_b = int(op_b, 0)
-            out_b = p8(val_b)
 
         except ValueError:
             # If it's not a value, it might be a symbol
-            out_b = f"sym:{op_b}"
+            val_b = op_b
 
-        code.append(f"{machine_code} # {opcode} {op_a},{op_b}")
-        code.append(p8(reg_a))
-        code.append(out_b)
-
-        addr += 3
+        program.append(Instruction(opcode, op_a, op_b, reg_a, val_b))
 
     def handle_ds(line):
         """
         Handle DS pseudo-opcode
         """
 
-        nonlocal addr
-
-        m = re.match(REGEX_DS, line, re.IGNORECASE)
+        m = REGEX_DS.match(line)
 
         if m is None or m.group(2) is None:
             print(f"line {line_num}: missing argument to DS", file=sys.stderr)
             sys.exit(2)
 
         data = m.group(2)
+        comments = []
 
-        for i in range(len(data)):
-            print_char = data[i]
-
+        for print_char in data:
             if print_char == ' ':
                 print_char = '[space]'
 
-            code.append(f"{p8(ord(data[i]))} # {print_char}")
+            comments.append(print_char)
 
-        addr += len(data)
+        program.append(Data([ord(c) & 0xff for c in data], comments))
 
     def handle_db(line):
         """
         Handle the DB pseudo-opcode
         """
 
-        nonlocal addr
-
-        m = re.match(REGEX_DB, line, re.IGNORECASE)
+        m = REGEX_DB.match(line)
 
         if m is None or m.group(2) is None:
             print(f"line {line}: missing argument to DB", file=sys.stderr)
@@ -264,9 +300,23 @@ def pass1(inputfile, sym, code):
         # Force to byte size
         val &= 0xff
 
-        code.append(f"{p8(val)} # {data}")
+        program.append(Data([val], [data]))
 
-        addr += 1
+    def handle_bank(op_a, op_b):
+        """
+        Handle the BANK pseudo-opcode
+        """
+
+        try:
+            number = int(op_a, 0)
+        except (TypeError, ValueError):
+            number = -1
+
+        if op_b is not None or not 0 <= number < MAX_BANKS:
+            print(f"line {line_num}: invalid bank number for BANK", file=sys.stderr)
+            sys.exit(2)
+
+        program.append(Bank(number))
 
     def check_ops(opcode, op_a, op_b):
         """Check operands for sanity with a particular opcode"""
@@ -330,24 +380,24 @@ def pass1(inputfile, sym, code):
 
         # print(line)  # debug
 
-        m = re.match(REGEX, line)
+        m = REGEX.match(line)
 
         if m is not None:
             label, opcode, op_a, op_b = normalize_line(m.groups())
 
             # print(label, opcode, op_a, op_b)  # debug
 
-            # Track label address
+            # Labels get their addresses in layout()
             if label is not None:
-                sym[label] = addr
-                # print(f"Label {label}: {addr}")  # debug
-                code.append(f'# {label} (address {addr}):')
+                program.append(Label(label))
 
             if opcode is not None:
                 if opcode == 'DS':
                     handle_ds(line)
                 elif opcode == 'DB':
                     handle_db(line)
+                elif opcode == 'BANK':
+                    handle_bank(op_a, op_b)
                 else:
                     # Check operand count
                     check_ops(opcode, op_a, op_b)
@@ -360,43 +410,684 @@ def pass1(inputfile, sym, code):
             print(f"No match: {input}", file=sys.stderr)
             sys.exit(3)
 
+    return program
+
 
-def pass2(outputfile, sym, code):
+def layout(program, sym):
     """
-    Output the code, substituting in any symbols.
+    Assign addresses to the parsed program, recording label offsets in sym
+    and emitting machine code. Returns a Layout; the bytes that take a
+    label's address are filled in by resolve().
+
+    Items after BANK N are placed in bank N, and their labels get addresses
+    in the bank window. Banks must come in increasing order, after the code
+    for RAM, which then has to end below the window.
     """
 
-    for c in code:
-        # Replace symbols
-        if c[:4] == 'sym:':
-            s = c[4:].strip()
+    image = bytearray()
+    fixups = []
+    headings = collections.defaultdict(list)
+    remarks = {}
 
-            if s in sym:
-                c = p8(sym[s])
+    # Current code address (for labels)
+    addr = 0
 
-            else:
-                print(f"unknown symbol: {s}", file=sys.stderr)
+    # Bank being laid out
+    bank = None
+
+    for item in program:
+        if isinstance(item, Bank):
+            if bank is None and addr > BANK_START:
+                print(f"code before BANK {item.number} runs into the bank window "
+                      f"at {BANK_START:#04x}", file=sys.stderr)
                 sys.exit(2)
+            if bank is not None and item.number <= bank:
+                print(f"BANK {item.number} comes after BANK {bank}; banks must "
+                      "be in increasing order", file=sys.stderr)
+                sys.exit(2)
+
+            # Pad up to the bank's place in the image
+            start = RAM_SIZE + item.number * BANK_SIZE
+            image.extend(bytes(start - len(image)))
+            headings[start].append(f"bank {item.number}:")
+            bank = item.number
+            addr = BANK_START
+            continue
+
+        offset = len(image)
 
-        outputfile.write(f"{c}\n")
+        if isinstance(item, Label):
+            sym[item.name] = addr
+            headings[offset].append(f"{item.name} (address {addr}):")
+
+        elif isinstance(item, Data):
+            image.extend(item.values)
+            remarks.update(enumerate(item.comments, offset))
+
+        else:
+            image.append(int(OPCODES[item.opcode]["code"], 2))
+            op_type = OPCODES[item.opcode]["type"]
+
+            if op_type == 0:
+                remarks[offset] = item.opcode
+            elif op_type == 1:
+                remarks[offset] = f"{item.opcode} {item.op_a}"
+                image.append(item.a)
+            else:
+                remarks[offset] = f"{item.opcode} {item.op_a},{item.op_b}"
+                image.append(item.a)
+                if isinstance(item.b, str):
+                    fixups.append((offset + 2, item.b))
+                    image.append(0)
+                else:
+                    image.append(item.b & 0xff)
+
+        addr += size(item)
+
+        if bank is not None and addr > BANK_START + BANK_SIZE:
+            print(f"bank {bank} is larger than {BANK_SIZE} bytes", file=sys.stderr)
+            sys.exit(2)
+
+    return Layout(image, fixups, headings, remarks)
+
+
+def pass1(inputfile, sym):
+    """
+    Pass 1
+
+    * Read the source code lines
+    * Parse labels, opcodes, and operands
+    * Record label offsets
+    * Emit machine code
+    """
+
+    return layout(parse(inputfile), sym)
+
+
+def size(item):
+    """
+    Number of bytes a parsed item takes in memory.
+    """
+
+    if isinstance(item, (Label, Bank)):
+        return 0
+    if isinstance(item, Data):
+        return len(item.values)
+    return TYPE_SIZES[OPCODES[item.opcode]["type"]]
+
+
+def registers_read(ins):
+    """
+    Registers whose value an instruction uses.
+    """
+
+    op_type = OPCODES[ins.opcode]["type"]
+
+    if ins.opcode in ("LDI", "POP"):
+        return set()
+    if ins.opcode == "LD":
+        return {ins.b}
+    if op_type == 1:
+        return {ins.a}
+    if op_type == 2:
+        return {ins.a, ins.b}
+    return set()
+
+
+def registers_written(ins):
+    """
+    Registers an instruction may change, or None if it may change any of
+    them (a subroutine or interrupt handler runs).
+    """
+
+    if ins.opcode in ("CALL", "INT", "IRET"):
+        return None
+    if ins.opcode in ("LDI", "LD", "INC", "DEC", "NOT") or (
+            OPCODES[ins.opcode]["type"] == 2 and ins.opcode not in ("CMP", "ST")):
+        return {ins.a}
+    if ins.opcode == "POP":
+        return {ins.a, 7}
+    if ins.opcode in ("PUSH", "RET"):
+        return {7}
+    return set()
+
+
+def jump_target(program, i):
+    """
+    The label a jump at program[i] goes to, if the instruction right before
+    it loads the jump register with a label.
+    """
+
+    ins = program[i]
+    if i == 0:
+        return None
+    prev = program[i - 1]
+    if (isinstance(prev, Instruction) and prev.opcode == "LDI"
+            and prev.a == ins.a and isinstance(prev.b, str)):
+        return prev.b
+    return None
+
+
+def label_index(program, name):
+    for i, item in enumerate(program):
+        if isinstance(item, Label) and item.name == name:
+            return i
+    return None
+
+
+def dead_at(program, name, reg):
+    """
+    True if reg is overwritten before it is read on the straight-line path
+    starting at label name. Anything the scan can't follow counts as a read.
+    """
+
+    start = label_index(program, name)
+    if start is None:
+        return False
+
+    for item in program[start:]:
+        if isinstance(item, Label):
+            continue
+        if not isinstance(item, Instruction):
+            return False
+        if reg in registers_read(item):
+            return False
+        written = registers_written(item)
+        if written is None:
+            return False
+        if reg in written or item.opcode == "HLT":
+            return True
+        if item.opcode in UNCONDITIONAL or item.opcode in CONDITIONAL:
+            return False
+
+    return True
+
+
+def drop_dead_code(program, rewrites):
+    """
+    Remove instructions that follow HLT, JMP, RET or IRET and have no label
+    in front of them, so nothing can reach them.
+    """
+
+    result = []
+    unreachable = False
+
+    for item in program:
+        if not isinstance(item, Instruction):
+            unreachable = False
+        elif unreachable:
+            rewrites["dead code"] += 1
+            continue
+        elif item.opcode in UNCONDITIONAL:
+            unreachable = True
+        result.append(item)
+
+    return result, 0
+
+
+def drop_push_pop(program, rewrites):
+    """
+    Remove PUSH Rx immediately followed by POP Rx.
+    """
+
+    result = []
+    saved = 0
+
+    for item in program:
+        prev = result[-1] if result else None
+        if (isinstance(item, Instruction) and item.opcode == "POP"
+                and isinstance(prev, Instruction) and prev.opcode == "PUSH"
+                and prev.a == item.a):
+            result.pop()
+            rewrites["PUSH/POP pair"] += 1
+            saved += 2
+            continue
+        result.append(item)
+
+    return result, saved
+
+
+def drop_jump_to_next(program, rewrites):
+    """
+    Remove a jump whose target label comes right after it. The LDI that set
+    up the jump register stays, as the register's value is still visible.
+    """
+
+    result = []
+    saved = 0
+
+    for i, item in enumerate(program):
+        if (isinstance(item, Instruction)
+                and (item.opcode == "JMP" or item.opcode in CONDITIONAL)):
+            target = jump_target(program, i)
+            following = program[i + 1:]
+            labels = []
+            for after in following:
+                if not isinstance(after, Label):
+                    break
+                labels.append(after.name)
+            if target is not None and target in labels:
+                rewrites["jump to next instruction"] += 1
+                saved += 1
+                continue
+        result.append(item)
+
+    return result, saved
+
+
+def drop_redundant_ldi(program, rewrites):
+    """
+    Remove LDI Rx,value when Rx is known to hold value already. What is
+    known is forgotten at every label, as other code may jump there.
+    """
+
+    result = []
+    saved = 0
+    known = {}
+
+    for item in program:
+        if not isinstance(item, Instruction):
+            known.clear()
+            result.append(item)
+            continue
+
+        if (item.opcode == "LDI" and item.a not in VOLATILE_REGISTERS
+                and item.a in known and known[item.a] == item.b):
+            rewrites["redundant LDI"] += 1
+            saved += 1
+            continue
+
+        written = registers_written(item)
+        if written is None or item.opcode in UNCONDITIONAL:
+            known.clear()
+        else:
+            for reg in written:
+                known.pop(reg, None)
+        if item.opcode == "LDI" and item.a not in VOLATILE_REGISTERS:
+            known[item.a] = item.b
+        result.append(item)
+
+    return result, saved
+
+
+def hoist_loop_ldi(program, rewrites):
+    """
+    Move the LDI Rx,Loop of a closing LDI Rx,Loop / JMP Rx in front of the
+    loop, so it runs once instead of on every iteration.
+
+    Only done when:
+
+    * nothing else loads the address of Loop, so the JMP is the only way in
+    * the loop body has no other labels, doesn't touch Rx and makes no calls
+      or returns
+    * Rx is dead wherever the body jumps out of the loop
+
+    If the same LDI Rx,Loop already sits just before the loop, the one in
+    the loop is dropped instead of moved.
+    """
+
+    for i, item in enumerate(program):
+        if not (isinstance(item, Instruction) and item.opcode == "JMP"):
+            continue
+        name = jump_target(program, i)
+        reg = item.a
+        if name is None or reg in VOLATILE_REGISTERS:
+            continue
+
+        start = label_index(program, name)
+        if start is None or start >= i - 1:
+            continue
+
+        # An identical LDI just before the loop already does the hoisting
+        entry = start
+        while entry > 0 and isinstance(program[entry - 1], Label):
+            entry -= 1
+        preloaded = entry > 0 and program[entry - 1] == program[i - 1]
+
+        references = sum(
+            1 for other in program
+            if isinstance(other, Instruction) and other.opcode == "LDI" and other.b == name)
+        if references != 1 + preloaded:
+            continue
+
+        body = program[start + 1:i - 1]
+        safe = True
+        for k, ins in enumerate(body, start + 1):
+            if not isinstance(ins, Instruction):
+                safe = False
+                break
+            written = registers_written(ins)
+            if written is None or reg in written or reg in registers_read(ins):
+                safe = False
+                break
+            if ins.opcode in ("RET", "IRET"):
+                safe = False
+                break
+            if ins.opcode == "JMP" or ins.opcode in CONDITIONAL:
+                exit_label = jump_target(program, k)
+                if exit_label is None or not dead_at(program, exit_label, reg):
+                    safe = False
+                    break
+        if not safe:
+            continue
+
+        rewrites["loop LDI hoisted"] += 1
+        ldi = program[i - 1]
+        if preloaded:
+            program = program[:i - 1] + program[i:]
+        else:
+            program = program[:start] + [ldi] + program[start:i - 1] + program[i:]
+        return program, 1
+
+    return program, 0
+
+
+def optimize(program):
+    """
+    Peephole pass over a parsed program. Returns the rewritten program, a
+    Counter of rewrites by pattern and the number of cycles saved (each
+    instruction is one cycle; for loops, the saving per iteration).
+
+    Code is assumed to be entered only at labels, so programs that jump to
+    computed addresses should not be optimized.
+    """
+
+    rewrites = collections.Counter()
+    cycles = 0
+    passes = (drop_dead_code, drop_push_pop, drop_jump_to_next,
+              drop_redundant_ldi, hoist_loop_ldi)
+
+    # Each rewrite can expose another, so repeat until nothing changes
+    changed = True
+    while changed:
+        changed = False
+        for rewrite in passes:
+            before = len(program)
+            program, saved = rewrite(program, rewrites)
+            cycles += saved
+            if len(program) != before or saved:
+                changed = True
+
+    return program, rewrites, cycles
+
+
+def resolve(program, sym):
+    """
+    Fill in the address of the label each fixup of a laid out program names.
+    """
+
+    for offset, name in program.fixups:
+        if name not in sym:
+            print(f"unknown symbol: {name}", file=sys.stderr)
+            sys.exit(2)
+
+        program.image[offset] = sym[name] & 0xff
+
+
+def pass2(outputfile, program):
+    """
+    Output the code as .ls8 text, one byte per line with the comments.
+    """
+
+    image = program.image
+
+    for offset in range(len(image) + 1):
+        for heading in program.headings.get(offset, ()):
+            outputfile.write(f"# {heading}\n")
+
+        if offset < len(image):
+            remark = program.remarks.get(offset)
+            if remark is None:
+                outputfile.write(f"{p8(image[offset])}\n")
+            else:
+                outputfile.write(f"{p8(image[offset])} # {remark}\n")
+
+
+def pass2_binary(outputfile, sym, program):
+    """
+    Output the code as a binary image with the symbol table attached.
+    """
+
+    image = program.image
+
+    outputfile.write(IMAGE_HEADER.pack(IMAGE_MAGIC, IMAGE_VERSION, 0,
+                                       len(sym), len(image)))
+    outputfile.write(image)
+
+    for name, address in sym.items():
+        encoded = name.encode()
+        outputfile.write(bytes([len(encoded)]) + encoded)
+        outputfile.write(IMAGE_SYMBOL.pack(address))
+
+
+def assemble(source, optimized=False):
+    """
+    Assemble LS-8 source text in memory.
+
+    Returns (program bytes, {label: address}). The bytes can be loaded with
+    CPU.load_bytes(). Raises ValueError if the source doesn't assemble; the
+    reason has been printed to stderr.
+    """
+
+    sym = {}
+
+    try:
+        program = parse(source.splitlines())
+        if optimized:
+            program = optimize(program)[0]
+        program = layout(program, sym)
+        resolve(program, sym)
+        return bytes(program.image), sym
+    except SystemExit:
+        raise ValueError("LS-8 source failed to assemble") from None
+
+
+def assemble_text(text, binary=False, optimized=False):
+    """
+    Assemble source text in memory and return the bytes of the output file.
+    """
+
+    sym = {}
+
+    program = parse(text.splitlines())
+    if optimized:
+        program = optimize(program)[0]
+    program = layout(program, sym)
+    resolve(program, sym)
+
+    if binary:
+        output = io.BytesIO()
+        pass2_binary(output, sym, program)
+        return output.getvalue()
+
+    output = io.StringIO()
+    pass2(output, program)
+    return output.getvalue().encode()
+
+
+def build_job(job):
+    """
+    Assemble one source for build(): job is (path, source bytes, binary,
+    optimized). Returns (path, output bytes or None if it failed).
+    """
+
+    path, data, binary, optimized = job
+
+    try:
+        return path, assemble_text(data.decode(), binary, optimized)
+    except SystemExit:
+        # The error has already been printed
+        return path, None
+
+
+def assembler_hash():
+    """
+    Hash of this file, so a changed assembler never reuses cached outputs.
+    """
+
+    with open(os.path.abspath(__file__), "rb") as f:
+        return hashlib.sha256(f.read()).digest()
+
+
+def write_if_changed(path, data):
+    """
+    Write data to path unless the file already holds exactly that. Returns
+    True if the file was written.
+    """
+
+    try:
+        with open(path, "rb") as f:
+            if f.read() == data:
+                return False
+    except OSError:
+        pass
+
+    with open(path, "wb") as f:
+        f.write(data)
+    return True
+
+
+def cache_store(cached, data):
+    """
+    Save a build output in the cache. A read-only cache only costs speed.
+    """
+
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        # Write under a temporary name so a concurrent build never sees half a file
+        fd, temporary = tempfile.mkstemp(dir=CACHE_DIR)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(temporary, cached)
+    except OSError:
+        pass
+
+
+def build(sources, outdir, binary=False, optimized=False, workers=None):
+    """
+    Assemble every source into outdir as name.ls8 (or name.ls8b), in one
+    process. Sources whose output is already cached are not assembled again,
+    and outputs that haven't changed are not rewritten. Large sets are
+    assembled across a process pool.
+
+    Returns a Counter of "assembled", "cached", "written", "unchanged" and
+    "failed" sources.
+    """
+
+    extension = ".ls8b" if binary else ".ls8"
+    flags = bytes([binary, optimized])
+    own_hash = assembler_hash()
+    stats = collections.Counter()
+    pending = []
+
+    os.makedirs(outdir, exist_ok=True)
+
+    def finish(path, output):
+        name = os.path.splitext(os.path.basename(path))[0] + extension
+        if write_if_changed(os.path.join(outdir, name), output):
+            stats["written"] += 1
+        else:
+            stats["unchanged"] += 1
+
+    for path in sources:
+        with open(path, "rb") as f:
+            data = f.read()
+
+        key = hashlib.sha256(own_hash + flags + data).hexdigest()
+        cached = os.path.join(CACHE_DIR, key + extension)
+
+        try:
+            with open(cached, "rb") as f:
+                output = f.read()
+        except OSError:
+            pending.append((path, data, cached))
+            continue
+
+        stats["cached"] += 1
+        finish(path, output)
+
+    jobs = [(path, data, binary, optimized) for path, data, cached in pending]
+    workers = workers or os.cpu_count()
+
+    if len(jobs) >= POOL_THRESHOLD and workers > 1:
+        chunksize = max(1, len(jobs) // (workers * 8))
+        with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+            results = list(pool.map(build_job, jobs, chunksize=chunksize))
+    else:
+        results = [build_job(job) for job in jobs]
+
+    for (path, output), (_, _, cached) in zip(results, pending):
+        if output is None:
+            print(f"{path}: failed", file=sys.stderr)
+            stats["failed"] += 1
+            continue
+
+        stats["assembled"] += 1
+        cache_store(cached, output)
+        finish(path, output)
+
+    return stats
+
+
+def build_main(argv):
+    """
+    Usage: asm.py --build outdir [--binary] [--optimize] [-j workers] source.asm...
+    """
+
+    binary = "--binary" in argv
+    optimized = "--optimize" in argv
+    args = [a for a in argv[1:] if a not in ("--binary", "--optimize")]
+
+    workers = None
+    if "-j" in args:
+        i = args.index("-j")
+        workers = int(args[i + 1])
+        del args[i:i + 2]
+
+    i = args.index("--build")
+    if i + 1 >= len(args):
+        print("usage: asm.py --build outdir [--binary] [--optimize] [-j workers] source.asm...",
+              file=sys.stderr)
+        return 1
+    outdir = args[i + 1]
+    sources = args[:i] + args[i + 2:]
+
+    stats = build(sources, outdir, binary, optimized, workers)
+
+    print(f"{len(sources)} sources: {stats['assembled']} assembled, "
+          f"{stats['cached']} from cache, {stats['written']} written, "
+          f"{stats['unchanged']} unchanged, {stats['failed']} failed",
+          file=sys.stderr)
+
+    return 1 if stats["failed"] else 0
 
 
 def main(argv):
+    if "--build" in argv:
+        return build_main(argv)
+
     # Parse command line
-    inputfile, outputfile = parse_commandline(argv)
+    inputfile, outputfile, binary, optimized = parse_commandline(argv)
 
     # Open files
-    inputfile, outputfile = open_files(inputfile, outputfile)
+    inputfile, outputfile = open_files(inputfile, outputfile, binary)
 
     # Set up the symbol table
     sym = {}
 
-    # Set up the machine code output
-    code = []
-
     # Assemble
-    pass1(inputfile, sym, code)
-    pass2(outputfile, sym, code)
+    program = parse(inputfile)
+    if optimized:
+        program, rewrites, cycles = optimize(program)
+        summary = ", ".join(f"{name} x{count}" for name, count in sorted(rewrites.items()))
+        print(f"optimizer: {cycles} cycles saved per pass ({summary or 'no changes'})",
+              file=sys.stderr)
+    program = layout(program, sym)
+    resolve(program, sym)
+    if binary:
+        pass2_binary(outputfile, sym, program)
+    else:
+        pass2(outputfile, program)
 
     return 0
 
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+"""Run many LS-8 programs across a pool of worker processes."""
+
+import argparse
+import collections
+import concurrent.futures
+import json
+import os
+import sys
+import time
+
+from cpu import CPU
+from devices import Console, Keyboard, Timer
+
+# One entry per program. reason is "halt", "cycles" (ran out of cycle
+# budget), "timeout" (ran out of wall-clock budget), "invalid" (an invalid
+# instruction) or "error"; error says what went wrong for the last two.
+Result = collections.namedtuple(
+    "Result", "path output reason cycles elapsed error")
+
+
+def run_program(path, max_cycles=None, timeout=None, keys=b"",
+                engine="interpreter", virtual_timer=None):
+    '''
+    Run one program on a fresh CPU and return its Result.
+    '''
+    output = bytearray()
+    timer = Timer(instructions=virtual_timer)
+    cpu = CPU(engine, Keyboard(keys), timer, Console(output))
+
+    start = time.perf_counter()
+    error = None
+    try:
+        cpu.load_file(path)
+        result = cpu.run(max_cycles, timeout=timeout)
+        reason = result.reason
+        if result.error is not None:
+            error = f"{type(result.error).__name__}: {result.error}"
+    except Exception as e:
+        reason = "error"
+        error = f"{type(e).__name__}: {e}"
+    elapsed = time.perf_counter() - start
+
+    return Result(path, bytes(output), reason, cpu.cycles, elapsed, error)
+
+
+def run_job(job):
+    '''
+    Pool entry point: job is (path, options dict).
+    '''
+    path, options = job
+    return run_program(path, **options)
+
+
+def warm_worker():
+    '''
+    Pool initializer: run a tiny program once so each worker has the
+    emulator imported and its code paths warm before real work arrives.
+    '''
+    cpu = CPU(console=Console(bytearray()))
+    cpu.ram[0] = 0b00000001  # HLT
+    cpu.run()
+
+
+def expand(paths):
+    '''
+    Expand directories into the programs they contain.
+    '''
+    programs = []
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if name.endswith((".ls8", ".ls8b")):
+                    programs.append(os.path.join(path, name))
+        else:
+            programs.append(path)
+    return programs
+
+
+def run_batch(paths, workers=None, **options):
+    '''
+    Run every program in paths (files or directories) across a process pool
+    and return their Results in order. Options are passed to run_program.
+    '''
+    programs = expand(paths)
+    jobs = [(path, options) for path in programs]
+    workers = workers or os.cpu_count()
+
+    if workers == 1:
+        return [run_job(job) for job in jobs]
+
+    # Hand out several programs per round trip when there are many of them
+    chunksize = max(1, len(jobs) // (workers * 8))
+    with concurrent.futures.ProcessPoolExecutor(workers, initializer=warm_worker) as pool:
+        return list(pool.map(run_job, jobs, chunksize=chunksize))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Run LS-8 programs in parallel.")
+    parser.add_argument("paths", nargs="+", help="programs or directories of programs")
+    parser.add_argument("-j", "--workers", type=int, default=None,
+                        help="worker processes (default: one per core)")
+    parser.add_argument("--max-cycles", type=int, default=None,
+                        help="instruction budget per program")
+    parser.add_argument("--timeout", type=float, default=10.0,
+                        help="wall-clock budget per program, in seconds")
+    parser.add_argument("--virtual-timer", type=int, default=None,
+                        help="fire the timer every N instructions")
+    parser.add_argument("--translate", action="store_true",
+                        help="use the block translator")
+    parser.add_argument("--json", action="store_true",
+                        help="print results as JSON")
+    args = parser.parse_args(argv[1:])
+
+    start = time.perf_counter()
+    results = run_batch(args.paths, args.workers,
+                        max_cycles=args.max_cycles,
+                        timeout=args.timeout,
+                        engine="translate" if args.translate else "interpreter",
+                        virtual_timer=args.virtual_timer)
+    elapsed = time.perf_counter() - start
+
+    if args.json:
+        print(json.dumps([
+            dict(r._asdict(), output=r.output.decode(errors="replace"))
+            for r in results
+        ], indent=2))
+    else:
+        for r in results:
+            print(f"{r.path:40} {r.reason:8} {r.cycles:12,} cycles "
+                  f"{r.elapsed * 1000:9.1f} ms {r.error or ''}")
+        print(f"{len(results)} programs in {elapsed:.2f}s", file=sys.stderr)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark suite for the LS-8 emulator.
+
+Runs the example programs and a few synthetic long-running workloads on
+every engine and reports instructions/second, ns/instruction and peak
+memory. Rates count only instructions actually run; idle loop iterations
+the CPU skipped are reported separately. Results can be saved as JSON and
+compared against a saved baseline:
+
+    python bench.py --output baseline.json
+    python bench.py --baseline baseline.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "asm"))
+
+import asm
+import image
+from cpu import CPU
+from devices import Banks, Console, Keyboard, Timer
+
+ENGINES = ("interpreter", "translate")
+
+EXAMPLES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "examples")
+
+# Run each workload repeatedly until at least this many seconds have passed
+MIN_TIME = 0.2
+
+# A drop in instructions/second bigger than this counts as a regression
+THRESHOLD = 0.10
+
+# Nested counting loops: R0 counts up until it wraps, R2 counts down
+COUNTING = """
+    LDI R2,60
+    LDI R3,Inner
+    LDI R4,0
+    LDI R0,0
+Inner:
+    INC R0
+    CMP R0,R4
+    JNE R3
+    DEC R2
+    CMP R2,R4
+    JNE R3
+    HLT
+"""
+
+# Recursion 40 calls deep, repeated 200 times
+RECURSION = """
+    LDI R1,0
+    LDI R2,Recurse
+    LDI R4,200
+Outer:
+    LDI R0,40
+    CALL R2
+    LDI R3,Outer
+    DEC R4
+    CMP R4,R1
+    JNE R3
+    HLT
+Recurse:
+    DEC R0
+    CMP R0,R1
+    LDI R3,Return
+    JEQ R3
+    CALL R2
+Return:
+    RET
+"""
+
+# Pushes and pops in a tight loop
+STACK = """
+    LDI R1,0
+    LDI R2,Loop
+    LDI R4,40
+    LDI R0,0
+Loop:
+    PUSH R0
+    PUSH R4
+    POP R3
+    POP R0
+    INC R0
+    CMP R0,R1
+    JNE R2
+    DEC R4
+    CMP R4,R1
+    JNE R2
+    HLT
+"""
+
+# Arithmetic in the inner loop, outer loop counter kept in RAM
+ALU = """
+    LDI R1,0
+    LDI R3,3
+    LDI R0,1
+Outer:
+    LDI R4,0
+Inner:
+    MUL R0,R3
+    ADD R0,R4
+    ADD R0,R3
+    CMP R0,R3
+    DEC R4
+    CMP R4,R1
+    LDI R2,Inner
+    JNE R2
+    LDI R2,Count
+    LD R4,R2
+    DEC R4
+    ST R2,R4
+    CMP R4,R1
+    LDI R2,Outer
+    JNE R2
+    HLT
+Count:
+    DB 30
+"""
+
+# Fills 256 banks of extended memory through the window at 0x80, then adds
+# them all up. Bank N's byte at address A holds A + N.
+BANKED = """
+    LDI R0,0
+Fill:
+    LDI R1,0xF5
+    ST R1,R0
+    LDI R2,0x80
+FillByte:
+    PUSH R2
+    POP R1
+    ADD R1,R0
+    ST R2,R1
+    INC R2
+    LDI R3,0xC0
+    CMP R2,R3
+    LDI R3,FillByte
+    JNE R3
+    INC R0
+    LDI R3,0
+    CMP R0,R3
+    LDI R3,Fill
+    JNE R3
+    LDI R4,0
+Sum:
+    LDI R1,0xF5
+    ST R1,R0
+    LDI R2,0x80
+SumByte:
+    LD R1,R2
+    ADD R4,R1
+    INC R2
+    LDI R3,0xC0
+    CMP R2,R3
+    LDI R3,SumByte
+    JNE R3
+    INC R0
+    LDI R3,0
+    CMP R0,R3
+    LDI R3,Sum
+    JNE R3
+    PRN R4
+    HLT
+"""
+
+
+def workloads():
+    '''
+    Return {name: (program, options)}. options are keys for the keyboard,
+    a cycle budget for programs that never halt, a virtual timer period and
+    the size of extended memory.
+    '''
+    suite = {}
+    for name in sorted(os.listdir(EXAMPLES)):
+        if name.endswith(".ls8"):
+            program = image.read_program(os.path.join(EXAMPLES, name))
+            suite[name] = (program, {"max_cycles": 200000, "virtual_timer": 10000})
+    suite["keyboard.ls8"][1]["keys"] = b"The quick brown fox jumps over the lazy dog"
+
+    for name, source in (("counting", COUNTING), ("recursion", RECURSION),
+                         ("stack", STACK), ("alu", ALU)):
+        suite[name] = (asm.assemble(source)[0], {"max_cycles": None, "virtual_timer": 1 << 30})
+    suite["banked"] = (asm.assemble(BANKED)[0],
+                       {"max_cycles": None, "virtual_timer": 1 << 30, "memory": 256 * 64})
+    return suite
+
+
+def run_once(engine, program, max_cycles=None, virtual_timer=None, keys=b"", memory=None):
+    '''
+    Run program on a fresh CPU. Returns (instructions, skipped, seconds,
+    outcome): the instructions actually run, and those counted as retired
+    while idle loops were skipped.
+    '''
+    timer = Timer(instructions=virtual_timer)
+    banks = Banks(memory) if memory else None
+    cpu = CPU(engine, Keyboard(keys), timer, Console(bytearray()), banks)
+    cpu.load_bytes(program)
+
+    start = time.perf_counter()
+    try:
+        result = cpu.run(max_cycles)
+        outcome = result.reason
+        if result.error is not None:
+            outcome = f"error: {type(result.error).__name__}"
+    except Exception as e:
+        outcome = f"error: {type(e).__name__}"
+    return cpu.cycles - cpu.skipped, cpu.skipped, time.perf_counter() - start, outcome
+
+
+def measure(engine, program, options):
+    '''
+    Benchmark one workload on one engine and return a result dict.
+    '''
+    instructions = 0
+    skipped = 0
+    seconds = 0
+    runs = 0
+    while seconds < MIN_TIME:
+        retired, idle, elapsed, outcome = run_once(engine, program, **options)
+        instructions += retired
+        skipped += idle
+        seconds += elapsed
+        runs += 1
+        if outcome.startswith("error"):
+            # A crashing program says nothing about speed
+            break
+
+    # Peak memory comes from a separate traced run, as tracing is slow
+    tracemalloc.start()
+    run_once(engine, program, **options)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {
+        "engine": engine,
+        "runs": runs,
+        "outcome": outcome,
+        "instructions": instructions,
+        # Skipped idle loop iterations, left out of the rates
+        "skipped": skipped,
+        "seconds": seconds,
+        "ips": instructions / seconds if instructions else 0.0,
+        "ns_per_instruction": seconds * 1e9 / max(instructions, 1),
+        "peak_kib": peak / 1024,
+    }
+
+
+def compare(results, baseline, threshold):
+    '''
+    Return a line for every workload/engine whose instructions/second fell
+    by more than threshold compared to the baseline.
+    '''
+    before = {(r["workload"], r["engine"]): r for r in baseline["results"]}
+    regressions = []
+    for r in results:
+        old = before.get((r["workload"], r["engine"]))
+        if old is None or not old["ips"]:
+            continue
+        change = r["ips"] / old["ips"] - 1
+        if change < -threshold:
+            regressions.append(f"{r['workload']} [{r['engine']}]: "
+                               f"{old['ips']:,.0f} -> {r['ips']:,.0f} instructions/s "
+                               f"({change:+.1%})")
+    return regressions
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmark the LS-8 emulator.")
+    parser.add_argument("workloads", nargs="*", help="workloads to run (default: all)")
+    parser.add_argument("--engine", action="append", choices=ENGINES,
+                        help="engine to benchmark (default: all)")
+    parser.add_argument("--output", help="write results to this JSON file")
+    parser.add_argument("--baseline", help="compare against this JSON file")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD,
+                        help="relative slowdown reported as a regression")
+    args = parser.parse_args(argv[1:])
+
+    suite = workloads()
+    names = args.workloads or list(suite)
+    engines = args.engine or ENGINES
+
+    results = []
+    for name in names:
+        program, options = suite[name]
+        for engine in engines:
+            result = dict(workload=name, **measure(engine, program, options))
+            results.append(result)
+            print(f"{name:18} {engine:12} {result['ips']:12,.0f} instructions/s "
+                  f"{result['ns_per_instruction']:8.1f} ns/instruction "
+                  f"{result['peak_kib']:8.1f} KiB peak  {result['outcome']}"
+                  + (f"  ({result['skipped']:,} idle skipped)" if result["skipped"] else ""))
+
+    report = {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "results": results,
+    }
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file), args.threshold)
+        for line in regressions:
+            print(f"REGRESSION {line}", file=sys.stderr)
+        if regressions:
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+
+"""
+Run a program on the warm server started with server.py.
+
+A drop-in replacement for ls8.py: it takes the same arguments, prints the
+same output and exits the same way, without paying for Python importing
+the emulator. When no server is listening, or for options only ls8.py has
+(--profile, --trace, --memory, --break), it runs ls8.py instead.
+
+    python client.py program.ls8 [--translate] [--input keys.txt] [--virtual-timer N]
+                     [--max-cycles N] [--timeout S] [--socket path]
+"""
+
+import os
+import socket
+import sys
+import threading
+
+import protocol
+from terminal import cbreak
+
+# Options that need the emulator in this process, or that the server
+# doesn't offer
+LOCAL_OPTIONS = ("--profile", "--trace", "--memory", "--break")
+
+
+def option(options, name, default=None):
+    '''
+    Value following name on the command line, the way ls8.py reads them.
+    '''
+    if name in options:
+        return options[options.index(name) + 1]
+    return default
+
+
+def send_keys(sock, fd):
+    '''
+    Forward everything read from fd to the server as key presses.
+    '''
+    while True:
+        try:
+            data = os.read(fd, 4096)
+        except OSError:
+            break
+        if not data:
+            break
+        try:
+            sock.sendall(protocol.frame(protocol.KEYS, data))
+        except OSError:
+            break
+
+
+def run_locally(argv):
+    '''
+    Replace this process with ls8.py.
+    '''
+    ls8 = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ls8.py")
+    os.execv(sys.executable, [sys.executable, ls8] + argv[1:])
+
+
+def main(argv):
+    if len(argv) < 2:
+        print("usage: client.py program.ls8 [options]", file=sys.stderr)
+        return 2
+    options = argv[2:]
+    if any(name in options for name in LOCAL_OPTIONS):
+        run_locally(argv)
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(option(options, "--socket", protocol.SOCKET))
+    except OSError:
+        run_locally(argv)
+
+    with open(argv[1], "rb") as file:
+        program = file.read()
+
+    # Keys come from --input (a file, or "-" for stdin) or from stdin, as
+    # they do for ls8.py. A file is sent with the request; stdin is
+    # forwarded as it is read.
+    keys = b""
+    path = option(options, "--input")
+    if path is not None and path != "-":
+        with open(path, "rb") as file:
+            keys = file.read()
+
+    sock.sendall(protocol.REQUEST.pack(
+        protocol.MAGIC,
+        protocol.ENGINES.index("translate" if "--translate" in options else "interpreter"),
+        len(program),
+        len(keys),
+        int(option(options, "--max-cycles", 0)),
+        int(option(options, "--virtual-timer", 0)),
+        float(option(options, "--timeout", 0))) + program + keys)
+
+    if path is None or path == "-":
+        fd = sys.stdin.fileno()
+        cbreak(fd)
+        threading.Thread(target=send_keys, args=(sock, fd), daemon=True).start()
+
+    stream = sock.makefile("rb")
+    stdout = sys.stdout.buffer
+    while True:
+        header = stream.read(protocol.FRAME.size)
+        if len(header) < protocol.FRAME.size:
+            print("Lost connection to the LS-8 server", file=sys.stderr)
+            return 1
+        kind, length = protocol.FRAME.unpack(header)
+        payload = stream.read(length)
+        if kind == protocol.OUTPUT:
+            stdout.write(payload)
+            stdout.flush()
+        elif kind == protocol.RESULT:
+            break
+
+    reason, cycles, pc, error = protocol.parse_result(payload)
+    if error:
+        print(error, file=sys.stderr)
+    elif reason != "halt":
+        print(f"Stopped after {cycles:,} cycles ({reason})", file=sys.stderr)
+    # Like ls8.py, which exits with status 1 on HLT too
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
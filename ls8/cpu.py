@@ -1,9 +1,13 @@
 """CPU functionality."""
 
+import collections
+import functools
+import struct
 import sys
-from datetime import datetime, timedelta
 import time
-import msvcrt 
+
+import image
+from devices import BANK_SIZE, KEY_ADDRESS, Banks, Console, Keyboard, Timer
 
 # ALU OPS
 
@@ -58,12 +62,196 @@ POP = 0b01000110 # Pop instruction off the stack
 PRN = 0b01000111 # Print a number
 PRA = 0b01001000
 
+# Opcode -> mnemonic, for tools that show instructions
+MNEMONICS = {
+    value: name for name, value in list(globals().items())
+    if name.isupper() and isinstance(value, int)
+}
+
+# Opcode -> the largest value its first and its second operand may hold: 7
+# where the operand names a register (all of them but LDI's immediate), 0xFF
+# otherwise. Opcodes without a mnemonic aren't checked.
+FIRST_OPERAND_LIMIT = bytes(
+    7 if IR in MNEMONICS and IR >> 6 >= 1 else 0xFF for IR in range(256))
+SECOND_OPERAND_LIMIT = bytes(
+    7 if IR in MNEMONICS and IR >> 6 == 2 and IR != LDI else 0xFF for IR in range(256))
+
+# Conditional jumps: the FL bits they test and whether they jump when any
+# of those bits is set (True) or when none is (False)
+JUMP_CONDITIONS = {
+    JEQ: (0b00000001, True),
+    JNE: (0b00000001, False),
+    JGT: (0b00000010, True),
+    JLT: (0b00000100, True),
+    JLE: (0b00000101, True),
+    JGE: (0b00000011, True),
+}
+
+# Longest fused pair of instructions, in bytes
+MAX_FUSED_LENGTH = 5
+
+# code_cover of a CPU that hasn't run yet: nothing is decoded, and the CPU
+# only allocates its own once it runs
+NOTHING_DECODED = bytes(256)
+
+# Interrupts raised by devices, the timer (I0) and the keyboard (I1): the
+# only way out of a loop that jumps to itself
+WAKE_INTERRUPTS = 0b00000011
+
+# Snapshots: kind (b"F" full, b"I" incremental), PC, FL, interrupts enabled
+# and cycles, then the registers, then for a CPU with extended memory the
+# selected bank and either all of extended memory or the number of banks
+# changed since the last snapshot followed by each as (bank number, bank
+# bytes), then either all of RAM or the RAM pages written since the last
+# snapshot, each as (page number, page bytes)
+SNAPSHOT_HEADER = struct.Struct("<cBBBQ")
+SNAPSHOT_BANK = struct.Struct("<H")
+SNAPSHOT_COUNT = struct.Struct("<I")
+PAGE_SHIFT = 4
+PAGE_SIZE = 1 << PAGE_SHIFT
+
+# What run() returns: why it stopped ("halt", "cycles", "timeout",
+# "until_pc", "idle", "invalid", or "breakpoint" and "watchpoint" from a
+# debugger), the instructions retired by that call, the PC it stopped at and
+# for "invalid", the InvalidInstruction raised
+RunResult = collections.namedtuple("RunResult", "reason cycles pc error", defaults=(None,))
+
+
+class Halt(Exception):
+    """Raised by HLT, and by NOP and division by zero, to stop the CPU."""
+
+
+class Stop(Exception):
+    """
+    Raised when run() reaches one of its limits: "cycles", "timeout",
+    "until_pc" or "idle", or a debugger's "breakpoint" or "watchpoint".
+    """
+
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class Idle(Exception):
+    """
+    Raised by a jump to itself while an interrupt can arrive, so the run
+    loop can skip spinning in it; see CPU.idle().
+    """
+
+
+class BranchTable(dict):
+    """
+    Opcode -> handler dict that counts changes to it, so run() only
+    rebuilds the decode table after the branchtable was changed.
+    """
+
+    version = 0
+
+    def __setitem__(self, IR, handler):
+        super().__setitem__(IR, handler)
+        self.version += 1
+
+    def __delitem__(self, IR):
+        super().__delitem__(IR)
+        self.version += 1
+
+    def update(self, *args, **kwargs):
+        super().update(*args, **kwargs)
+        self.version += 1
+
+    def pop(self, *args):
+        self.version += 1
+        return super().pop(*args)
+
+    def setdefault(self, IR, handler=None):
+        self.version += 1
+        return super().setdefault(IR, handler)
+
+    def clear(self):
+        super().clear()
+        self.version += 1
+
+
+class InvalidInstruction(Exception):
+    """
+    Raised for an opcode the CPU has no handler for, or an instruction whose
+    operands run past the end of RAM.
+    """
+
+    def __init__(self, IR, pc, message=None):
+        super().__init__(message or f"Unknown instruction {IR:08b} at address {pc:02X}")
+        self.IR = IR
+        self.pc = pc
+
+
+class InvalidRegister(InvalidInstruction):
+    """Raised for an instruction naming a register past R7."""
+
+    def __init__(self, IR, pc, reg):
+        super().__init__(IR, pc, f"Invalid register {reg} in instruction {IR:08b} at address {pc:02X}")
+        self.reg = reg
+
+
+def check_instruction(ram, pc):
+    '''
+    Raise InvalidInstruction if the instruction at pc can't run: its operands
+    would run past the end of ram, or it names a register past R7. Unknown
+    opcodes are left to their handler.
+    '''
+    IR = ram[pc]
+    if pc + (IR >> 6) >= len(ram):
+        raise InvalidInstruction(IR, pc, f"Instruction {IR:08b} at address {pc:02X} "
+                                         "runs past the end of RAM")
+    limits = (FIRST_OPERAND_LIMIT[IR], SECOND_OPERAND_LIMIT[IR])
+    for operand, limit in zip(ram[pc + 1:pc + 1 + (IR >> 6)], limits):
+        if operand > limit:
+            raise InvalidRegister(IR, pc, operand)
+
+
+def uses_keyboard(ram):
+    '''
+    Guess whether the program in ram reads the keyboard: True if an LDI in it
+    loads the address of the keyboard register or of the keyboard
+    interrupt's vector (0xF9), as programs must to reach them. Data that
+    happens to look like such an LDI only makes it guess yes.
+    '''
+    for pc in range(len(ram) - 2):
+        if ram[pc] == LDI and ram[pc + 2] in (KEY_ADDRESS, 0xF9):
+            return True
+    return False
+
+
+def call_handler(handler, cpu, *operands):
+    '''
+    Decode table entry for a branchtable handler that isn't one of the CPU's
+    own, such as a profiler's: takes the CPU like the others and drops it.
+    '''
+    return handler(*operands)
+
+
 class CPU:
     """Main CPU class."""
 
-    def __init__(self):
-        """Construct a new CPU."""
-        self.register = [0] * 8
+    def __init__(self, engine="interpreter", keyboard=None, timer=None, console=None, banks=None):
+        """
+        Construct a new CPU.
+
+        engine is "interpreter" to dispatch one instruction at a time, or
+        "translate" to compile basic blocks into Python functions and run those.
+
+        keyboard is a Keyboard device. By default a keyboard with no input
+        source is attached when the CPU first runs.
+
+        timer is a Timer device. By default a one second wall-clock timer.
+
+        console is the Console that PRN and PRA write to. By default it
+        buffers output for stdout.
+
+        banks is a Banks device giving the CPU extended memory, switched in
+        through a window in RAM. By default there is none.
+        """
+        # Registers and RAM hold bytes; every write is wrapped to 8 bits
+        self.register = bytearray(8)
         self.interrupt_mask = 5
         self.interrupt_status = 6
         self.sp = 7
@@ -80,214 +268,277 @@ class CPU:
         self.greater_than = 0b00000010
         self.equal_to = 0b00000001
 
-        self.ram = [0] * 255
+        self.ram = bytearray(256)
+        # One flag per RAM page, set when the page is written
+        self.dirty = bytearray(len(self.ram) >> PAGE_SHIFT)
+
+        # Memory-mapped devices: for each mapped address, the callbacks that
+        # take its loads and stores, and a flag per address so plain RAM
+        # accesses only pay for testing one byte. Set with map_device().
+        self.readers = {}
+        self.writers = {}
+        self.device_reads = bytearray(len(self.ram))
+        self.device_writes = bytearray(len(self.ram))
         self.pc = 0
-        self.branchtable = {}
-        
-        self.branchtable[LDI] = self.handle_LDI
-        self.branchtable[PRN] = self.handle_PRN
-        self.branchtable[HLT] = self.handle_HLT
-        self.branchtable[MUL] = self.handle_MUL
-        self.branchtable[POP] = self.handle_POP
-        self.branchtable[PUSH] = self.handle_PUSH
-        self.branchtable[CALL] = self.handle_CALL
-        self.branchtable[RET] = self.handle_RET
-        self.branchtable[ADD] = self.handle_ADD
-        self.branchtable[ST] = self.handle_ST
-        self.branchtable[IRET] = self.handle_IRET
-        self.branchtable[JMP] = self.handle_JMP
-        self.branchtable[PRA] = self.handle_PRA
-        self.branchtable[NOP] = self.handle_NOP
-        self.branchtable[LD] = self.handle_LD
-        self.branchtable[CMP] = self.handle_CMP
-        self.branchtable[JLT] = self.handle_JLT
-        self.branchtable[JNE] = self.handle_JNE
-        self.branchtable[JEQ] = self.handle_JEQ
-        self.branchtable[JGE] = self.handle_JGE
-        self.branchtable[DEC] = self.handle_DEC
-        self.branchtable[INC] = self.handle_INC
+        # This CPU's branchtable once it has been used; see branchtable
+        self.own_branchtable = None
+
+        # Built from the branchtable when the CPU starts running, and again
+        # whenever the branchtable's version changes
+        self.decode = None
+        self.decoded_version = None
+
+        # Per-address instruction cache used by run(). Each entry is
+        # (run, size, sets PC, instructions retired): run is the handler with
+        # the CPU and its operands bound, or a fused handler for a pair of
+        # instructions. Made on the first run. Addresses start out holding
+        # the shared `miss` entry and are decoded on first use, and
+        # code_cover marks the bytes they were decoded from so a write there
+        # drops them again; until the first run it is NOTHING_DECODED.
+        self.code = []
+        self.miss = None
+        self.code_cover = NOTHING_DECODED
 
         self.register[self.sp] = 0xF4 # initialized to point at key press
         self.interrupt_handler_address = 0
         self.interrupts_enabled = True
-
-        self.init_time = 0
-    def kbfunc(self): 
+        # True when interrupts are enabled and IM & IS is non-zero. Kept up to
+        # date by everything that changes IM, IS or interrupts_enabled, so the
+        # run loop only has to test this before each instruction.
+        self.interrupt_pending = False
+
+        # Number of instructions retired since the CPU started running, and
+        # how many of those idle() skipped instead of running
+        self.cycles = 0
+        self.skipped = 0
+
+        # Limits of the current run() call; see run()
+        self.stop_cycles = None
+        self.stop_time = None
+        self.until_pc = None
+        self.timer_started = False
+
+        # Sleep in idle loops; see idle()
+        self.idle_sleep = True
+
+        # The default keyboard is only made when the CPU first runs
+        self.keyboard = keyboard
+        self.timer = timer if timer is not None else Timer()
+        self.console = console if console is not None else Console()
+        self.banks = banks
+        if keyboard is not None:
+            keyboard.attach(self)
+        if banks is not None:
+            banks.attach(self)
+
+        # Set by attaching a profiler.Profiler, a tracer.Tracer or a
+        # debugger.Debugger
+        self.profiler = None
+        self.tracer = None
+        self.debugger = None
+
+        self.engine = engine
+        self.translator = None
+        if engine == "translate":
+            from translate import BlockTranslator
+            self.translator = BlockTranslator(self)
+        elif engine != "interpreter":
+            raise ValueError(f"Unknown engine {engine}")
+
+    def kbfunc(self):
         '''
-        Catches a keyboard input.
-        Saves that value as a number in ram
-        Adds 2 to the interrupt status
+        Takes the next key press off the keyboard queue.
+        Latches it in the keyboard's register, mapped at 0xF4
+        Sets bit 1 of the interrupt status
+
+        Only called when the queue is non-empty. While the keyboard interrupt
+        is unmasked, a key stays queued until the previous one has been
+        handled (its IS bit is clear and no interrupt handler is running), so
+        fast typing doesn't overwrite 0xF4 under the handler. With it masked,
+        every key is latched, for programs that poll 0xF4.
         '''
-        x = msvcrt.kbhit()
-        if x: 
-            # Creates a number associated with the keyboard input
-            ret = ord(msvcrt.getch()) 
+        if self.register[self.interrupt_mask] & 0b00000010 and (
+                not self.interrupts_enabled or self.register[self.interrupt_status] & 0b00000010):
+            return
+
+        # The interrupt handler loads the key from 0xF4 to print out the letter
+        self.keyboard.key = self.keyboard.keys.popleft()
 
-            # Storing the keyboard press value in ram at this location
-            # This value will be grabbed later by the interrupt operation to print out the letter
-            self.ram[0xf4] = ret
+        # OR into the register instead of overwriting in case there are other interrupt statuses being created
+        self.register[self.interrupt_status] |= 0b00000010
+        self.update_interrupts()
 
-            # Adding to the register instead of overwriting in case there are other interrupt statuses being created
-            self.register[self.interrupt_status] += 0b00000010
-    def handle_DEC(self):
+    def update_interrupts(self):
+        '''
+        Recompute interrupt_pending after IM, IS or interrupts_enabled changed.
+        '''
+        self.interrupt_pending = self.interrupts_enabled and bool(
+            self.register[self.interrupt_mask] & self.register[self.interrupt_status])
+    def handle_DEC(self, reg):
         '''
         Decrement (subtract 1 from) the value in the given register.
         '''
-        reg = self.ram_read(self.pc + 1)
-        self.register[reg] -= 1
+        self.register[reg] = (self.register[reg] - 1) & 0xFF
+        if reg >= 5:
+            self.update_interrupts()
 
-        self.pc += 2
-    def handle_INC(self):
+    def handle_INC(self, reg):
         '''
         Increment (Add 1 to) the value in the given register.
         '''
-        reg = self.ram_read(self.pc + 1)
-        self.register[reg] += 1
-
-        self.pc += 2
+        self.register[reg] = (self.register[reg] + 1) & 0xFF
+        if reg >= 5:
+            self.update_interrupts()
 
-    def handle_CMP(self):
+    def handle_CMP(self, operand_a, operand_b):
         '''
         Compare the values in two registers.
         If they are equal, set the Equal E flag to 1, otherwise set it to 0.
         If registerA is less than registerB, set the Less-than L flag to 1, otherwise set it to 0.
         If registerA is greater than registerB, set the Greater-than G flag to 1, otherwise set it to 0.
         '''
-        operand_a = self.ram_read(self.pc +1)
-        operand_b = self.ram_read(self.pc +2)
-        self.alu("CMP", operand_a, operand_b)
-        self.pc += 3
+        a = self.register[operand_a]
+        b = self.register[operand_b]
+        if a < b:
+            self.FL = self.less_than
+        elif a > b:
+            self.FL = self.greater_than
+        else:
+            self.FL = self.equal_to
 
-    def handle_JLT(self):
+    def handle_JLT(self, reg):
         '''
         If less-than flag is set (true), jump to the address stored in the given register.
         '''
         if self.less_than & self.FL:
-            reg = self.ram_read(self.pc + 1)
             self.pc = self.register[reg]
         else:
-            self.pc +=2
+            self.pc = (self.pc + 2) & 0xFF
 
-    def handle_JNE(self):
+    def handle_JLE(self, reg):
+        '''
+        If less-than flag or equal flag is set (true), jump to the address stored in the given register.
+        '''
+        if (self.less_than | self.equal_to) & self.FL:
+            self.pc = self.register[reg]
+        else:
+            self.pc = (self.pc + 2) & 0xFF
+
+    def handle_JNE(self, reg):
         ''' 
         If E flag is clear (false, 0), jump to the address stored in the given register.
         '''
         if not self.equal_to & self.FL:
-            reg = self.ram_read(self.pc + 1)
             self.pc = self.register[reg]
         else:
-            self.pc += 2
+            self.pc = (self.pc + 2) & 0xFF
 
-    def handle_JGE(self):
+    def handle_JGT(self, reg):
         '''
-        If greater-than flag or equal flag is set (true), jump to the address stored in the given register.
+        If greater-than flag is set (true), jump to the address stored in the given register.
         '''
         if self.greater_than & self.FL:
-            reg = self.ram_read(self.pc + 1)
             self.pc = self.register[reg]
         else:
-            self.pc += 2
+            self.pc = (self.pc + 2) & 0xFF
 
-    def handle_JEQ(self):
+    def handle_JGE(self, reg):
         '''
-        If equal flag is set (true), jump to the address stored in the given register.
+        If greater-than flag or equal flag is set (true), jump to the address stored in the given register.
         '''
+        if (self.greater_than | self.equal_to) & self.FL:
+            self.pc = self.register[reg]
+        else:
+            self.pc = (self.pc + 2) & 0xFF
 
+    def handle_JEQ(self, reg):
+        '''
+        If equal flag is set (true), jump to the address stored in the given register.
+        '''
         if self.equal_to & self.FL:
-            reg = self.ram_read(self.pc + 1)
             self.pc = self.register[reg]
         else:
-            self.pc += 2
+            self.pc = (self.pc + 2) & 0xFF
 
-    def handle_interrupt(self):
+    def handle_INT(self, reg):
         '''
-        Run timer interrupt every 1 second
-        Check to see if any interrupt status have been triggered.
-        If a masked interrupt exists from program code that was executed, run interrupt sequence relevant to that interrupt type
+        Issue the interrupt number stored in the given register.
+        Sets that bit in IS; the interrupt is taken before the next instruction.
         '''
+        self.register[self.interrupt_status] |= 1 << (self.register[reg] & 0b111)
+        self.update_interrupts()
+        self.pc = (self.pc + 2) & 0xFF
 
-        # Find current time to check initialized time against. 
-        current_time = time.time()
-
-        # We find out if 1 second has passed
-        if current_time - self.init_time >=1:
-            
-            # Reset base time to check against
-            self.init_time = time.time() 
-
-            # R6 is reserved for the interrupt_status
-            self.register[self.interrupt_status] += 0b00000001 # Interrupt status is on? (0b00000001)
+    def handle_interrupt(self):
+        '''
+        Take the highest-priority pending interrupt. Only called when
+        interrupt_pending is set.
 
-        # If interrupt mask is on and interrupt status is on, this will evaluate to 1
+        Interrupt n (the lowest set bit of IM & IS) jumps through the vector
+        at 0xF8 + n; only its bit is cleared in IS, so any other pending
+        interrupt is taken after IRET.
+        The timer sets its status bit from tick(), between slices of instructions
+        '''
         masked_interrupts = self.register[self.interrupt_mask] & self.register[self.interrupt_status]
 
-        # Check if interrupt status is switched on
-        for i in range(8):
+        # Isolate the lowest set bit and take its position
+        i = (masked_interrupts & -masked_interrupts).bit_length() - 1
 
-            # Right shift interrupts down by i, then mask with 1 to see if that bit was set
-            interrupt_happened = ((masked_interrupts >> i) & 1) == 1
+        # Based on the type of interrupt, we set the interrupt handler the relevant ram address
+        self.interrupt_handler_address = 0xF8 + i
 
-            # If a bit is set:
-            if interrupt_happened:
-                # Based on the type of interrupt, we set the interrupt handler the relevant ram address
-                self.interrupt_handler_address = 247 + masked_interrupts
+        # Disable further interrupts.
+        self.interrupts_enabled = False
+        self.interrupt_pending = False
 
-                # Disable further interrupts.
-                self.interrupts_enabled = False
+        # Clear the bit in the IS register.
+        self.register[self.interrupt_status] &= ~(1 << i) & 0xFF
 
-                # Clear the bit in the IS register.
-                # Reset Interrupt status to 0
-                self.register[self.interrupt_status] = 0
+        # The PC register is pushed on the stack.
+        self.register[self.sp] = (self.register[self.sp] - 1) & 0xFF
+        SP = self.register[self.sp]
+        self.ram_write(self.pc, SP)
 
-                # The PC register is pushed on the stack.
-                self.register[self.sp] -= 1
-                SP = self.register[self.sp]
-                self.ram_write(self.pc, SP)
+        # The FL register is pushed on the stack.
+        self.register[self.sp] = (self.register[self.sp] - 1) & 0xFF
+        SP = self.register[self.sp]
+        self.ram_write(self.FL, SP)
 
-                # The FL register is pushed on the stack.
-                self.register[self.sp] -= 1
-                SP = self.register[self.sp]
-                self.ram_write(self.FL, SP)
-                
-                # Registers R0-R6 are pushed on the stack in that order.
-                for j in range(7):
-                    self.register[self.sp] -= 1
-                    SP = self.register[self.sp]
-                    self.ram_write(self.register[j], SP)
+        # Registers R0-R6 are pushed on the stack in that order.
+        for j in range(7):
+            self.register[self.sp] = (self.register[self.sp] - 1) & 0xFF
+            SP = self.register[self.sp]
+            self.ram_write(self.register[j], SP)
 
-                # The address (vector in interrupt terminology) of the appropriate handler is looked up from the interrupt vector table.
-                # Set the PC is set to the handler address.
-                self.pc = self.ram[self.interrupt_handler_address]
+        # The address (vector in interrupt terminology) of the appropriate handler is looked up from the interrupt vector table.
+        # Set the PC is set to the handler address.
+        self.pc = self.ram_read(self.interrupt_handler_address)
 
-                # Stop further checking of maskedInterrupts.
-                break
+        if self.profiler is not None:
+            self.profiler.enter_interrupt(i)
 
     def handle_NOP(self):
-        print("THIS IS NOP. EXITING PROGRAM")
-        sys.exit(1)
+        self.console.write(b"THIS IS NOP. EXITING PROGRAM\n")
+        raise Halt()
     
-    def handle_PRA(self):
+    def handle_PRA(self, reg):
         '''
         Print alpha character value stored in the given register.
 
         Print to the console the ASCII character corresponding to the value in the register.
         
         '''
-        reg = self.ram_read(self.pc + 1)
         print_char = self.register[reg]
         if self.interrupts_enabled == False:
-            print(chr(print_char))
+            self.console.write((chr(print_char) + "\n").encode())
         else:
-            print(chr(print_char),end="")
-        self.pc += 2
+            self.console.write(chr(print_char).encode())
 
-    def handle_JMP(self):
+    def handle_JMP(self, reg):
         '''
         Jump to the address stored in the given register.
         Set the PC to the address stored in the given register.
         '''
-        reg = self.ram_read(self.pc + 1)
-
         self.pc = self.register[reg]
 
     def handle_IRET(self):
@@ -301,170 +552,365 @@ class CPU:
         for i in range(6, -1, -1):
 
             SP = self.register[self.sp]
-            value = self.ram[SP]
+            value = self.ram_read(SP)
             self.register[i] = value
-            self.register[self.sp] += 1
+            self.register[self.sp] = (self.register[self.sp] + 1) & 0xFF
 
         # The FL register is popped off the stack.
         SP = self.register[self.sp]
-        value = self.ram[SP]
+        value = self.ram_read(SP)
         self.FL = value
-        self.register[self.sp] += 1
+        self.register[self.sp] = (self.register[self.sp] + 1) & 0xFF
 
         # The return address is popped off the stack and stored in PC.
         SP = self.register[self.sp]
-        value = self.ram[SP]
+        value = self.ram_read(SP)
         self.pc = value
-        self.register[self.sp] += 1
+        self.register[self.sp] = (self.register[self.sp] + 1) & 0xFF
 
         # Interrupts are re-enabled
         self.interrupts_enabled = True
+        self.update_interrupts()
 
-    def handle_ST(self):
+    def handle_ST(self, regA, regB):
         '''
         Take the value in registerB and store in the RAM ADDRESS stored in registerA
         '''
-        regA = self.ram[self.pc+1] # 0
-        regB = self.ram[self.pc + 2] # 1
         reg_a_value = self.register[regA]
         reg_b_value = self.register[regB] 
-        self.ram[reg_a_value] = reg_b_value
-        self.pc += 3
-    def handle_LD(self):
+        self.ram_write(reg_b_value, reg_a_value)
+
+    def handle_LD(self, regA, regB):
         '''
         Loads registerA with the value at the RAM address stored in registerB.
         '''
-        regA = self.ram[self.pc+1] # 0
-        regB = self.ram[self.pc + 2] # 1
         reg_b_value = self.register[regB] 
-        self.register[regA] = self.ram[reg_b_value]
-        print(f"regA is {regA}")
-        print(f"regB is {regB}")
-        print(f"reg_b_value is {reg_b_value}")
-        self.pc += 3
-    def handle_CALL(self):
+        if self.device_reads[reg_b_value]:
+            self.register[regA] = self.readers[reg_b_value](reg_b_value)
+        else:
+            self.register[regA] = self.ram[reg_b_value]
+        if regA >= 5:
+            self.update_interrupts()
+
+    def handle_CALL(self, reg):
         '''
         Set the PC to the address of a called subroutine.
         Save the address of the operation that follows CALL in the stack
         '''
+        self.register[self.sp] = (self.register[self.sp] - 1) & 0xFF
+        SP = self.register[self.sp]
 
-        # Push that onto the stack
-        self.handle_PUSH(True)
+        # Push the address of the next operation onto the stack
+        value = (self.pc + 2) & 0xFF
+        self.pc = self.register[reg]
+
+        self.ram_write(value, SP)
 
     def handle_RET(self):
         '''
         Pop saved PC address off stack and move PC to that location
         continue operations from there
         '''
-        self.handle_POP(True)
+        SP = self.register[self.sp]
 
-    def handle_POP(self, ret = False):
+        # Move PC back to the next operation after the CALL
+        if self.device_reads[SP]:
+            self.pc = self.readers[SP](SP)
+        else:
+            self.pc = self.ram[SP]
+
+        self.register[self.sp] = (self.register[self.sp] + 1) & 0xFF
+
+    def handle_POP(self, reg):
         '''
         Copy value of most recently pushed stack item to given registry address.
         Move stack pointer to previously pushed stack item
-        if ret = True, set PC to the popped value and don't save into register
         '''
         SP = self.register[self.sp]
-        value = self.ram[SP]
+        if self.device_reads[SP]:
+            value = self.readers[SP](SP)
+        else:
+            value = self.ram[SP]
 
-        if not ret:
-            reg = self.ram_read(self.pc + 1)
-            self.register[reg] = value
-            self.pc += 2
-        else: # RET POP
-            self.pc = value # Move PC back to the next operation after the CALL
+        self.register[reg] = value
+        if reg >= 5:
+            self.update_interrupts()
 
-        self.register[self.sp] += 1
+        self.register[self.sp] = (self.register[self.sp] + 1) & 0xFF
 
-    def handle_PUSH(self, call = False):
+    def handle_PUSH(self, reg):
         '''
         Push value from given registry address onto next stack. 
         Leave stack pointer at most recently pushed value
-        If call == True, store value of next operation and set pointer to the address saved in the next byte
         '''
-        self.register[self.sp] -= 1
+        self.register[self.sp] = (self.register[self.sp] - 1) & 0xFF
         SP = self.register[self.sp]
 
-        if not call:
-            reg = self.ram_read(self.pc + 1)
-            value = self.register[reg]
-            self.pc += 2
-        else: # CALL PUSH
-            value = self.pc + 2
-            self.pc = self.register[self.ram_read(self.pc + 1)]
+        value = self.register[reg]
 
         self.ram_write(value, SP)
 
-    def handle_LDI(self):
+    def handle_LDI(self, reg, num):
         '''
         Given a registry address and a number, put number into registry.
         '''
-        reg = self.ram_read(self.pc + 1)
-        num = self.ram_read(self.pc + 2)
         self.register[reg] = num
-        self.pc += 3
+        if reg >= 5:
+            self.update_interrupts()
 
-    def handle_PRN(self):
+    def handle_PRN(self, reg):
         '''
         Given a registry address, print number value that exists there
         '''
-        reg = self.ram_read(self.pc + 1)
         num = self.register[reg]
-        print(num)
-        self.pc += 2
+        self.console.write(b"%d\n" % num)
 
     def handle_HLT(self):
         '''
         Halt Program
         '''
-        sys.exit(1)
+        raise Halt()
 
-    def handle_MUL(self):
+    def handle_MUL(self, operand_a, operand_b):
         '''
         Given two registry addresses, 
         multiply them together and save the value in the first registry
         '''
-        operand_a = self.ram_read(self.pc + 1)
-        operand_b = self.ram_read(self.pc + 2)
-        self.alu("MUL", operand_a, operand_b)
-        self.pc += 3
-    def handle_ADD(self):
-        operand_a = self.ram_read(self.pc + 1)
-        operand_b = self.ram_read(self.pc + 2)
-        self.alu("ADD", operand_a, operand_b)
-        self.pc += 3
+        self.register[operand_a] = (self.register[operand_a] * self.register[operand_b]) & 0xFF
+        if operand_a >= 5:
+            self.update_interrupts()
+
+    def handle_ADD(self, operand_a, operand_b):
+        '''
+        Add the value in registerB to registerA.
+        '''
+        self.register[operand_a] = (self.register[operand_a] + self.register[operand_b]) & 0xFF
+        if operand_a >= 5:
+            self.update_interrupts()
+
+    def handle_SUB(self, operand_a, operand_b):
+        '''
+        Subtract the value in registerB from registerA.
+        '''
+        self.register[operand_a] = (self.register[operand_a] - self.register[operand_b]) & 0xFF
+        if operand_a >= 5:
+            self.update_interrupts()
+
+    def handle_DIV(self, operand_a, operand_b):
+        '''
+        Divide the value in registerA by registerB, storing the quotient in registerA.
+        Halts with an error if registerB is 0.
+        '''
+        divisor = self.register[operand_b]
+        if divisor == 0:
+            self.divide_by_zero()
+        self.register[operand_a] = self.register[operand_a] // divisor
+        if operand_a >= 5:
+            self.update_interrupts()
+
+    def handle_MOD(self, operand_a, operand_b):
+        '''
+        Divide the value in registerA by registerB, storing the remainder in registerA.
+        Halts with an error if registerB is 0.
+        '''
+        divisor = self.register[operand_b]
+        if divisor == 0:
+            self.divide_by_zero()
+        self.register[operand_a] = self.register[operand_a] % divisor
+        if operand_a >= 5:
+            self.update_interrupts()
+
+    def handle_AND(self, operand_a, operand_b):
+        '''
+        Bitwise-AND registerA and registerB, storing the result in registerA.
+        '''
+        self.register[operand_a] &= self.register[operand_b]
+        if operand_a >= 5:
+            self.update_interrupts()
+
+    def handle_OR(self, operand_a, operand_b):
+        '''
+        Bitwise-OR registerA and registerB, storing the result in registerA.
+        '''
+        self.register[operand_a] |= self.register[operand_b]
+        if operand_a >= 5:
+            self.update_interrupts()
+
+    def handle_XOR(self, operand_a, operand_b):
+        '''
+        Bitwise-XOR registerA and registerB, storing the result in registerA.
+        '''
+        self.register[operand_a] ^= self.register[operand_b]
+        if operand_a >= 5:
+            self.update_interrupts()
+
+    def handle_NOT(self, reg):
+        '''
+        Bitwise-NOT the value in the given register.
+        '''
+        self.register[reg] ^= 0xFF
+        if reg >= 5:
+            self.update_interrupts()
+
+    def handle_SHL(self, operand_a, operand_b):
+        '''
+        Shift registerA left by the number of bits in registerB, filling with 0.
+        '''
+        self.register[operand_a] = (self.register[operand_a] << self.register[operand_b]) & 0xFF
+        if operand_a >= 5:
+            self.update_interrupts()
+
+    def handle_SHR(self, operand_a, operand_b):
+        '''
+        Shift registerA right by the number of bits in registerB, filling with 0.
+        '''
+        self.register[operand_a] >>= self.register[operand_b]
+        if operand_a >= 5:
+            self.update_interrupts()
+
+    def divide_by_zero(self):
+        '''
+        DIV or MOD by 0: print an error and halt, as the spec asks.
+        '''
+        self.console.write(b"Error: division by zero at address %02X\n" % self.pc)
+        raise Halt()
+
+    def handle_unknown(self, *operands):
+        '''
+        Decode table entry for opcodes that have no handler.
+        '''
+        raise InvalidInstruction(self.ram[self.pc], self.pc)
+
+    # Opcode -> handler for every instruction the CPU implements, as plain
+    # functions taking the CPU first. Every CPU decodes with one table
+    # built from these until its branchtable is used.
+    handlers = {
+        LDI: handle_LDI,
+        PRN: handle_PRN,
+        HLT: handle_HLT,
+        POP: handle_POP,
+        PUSH: handle_PUSH,
+        CALL: handle_CALL,
+        RET: handle_RET,
+        ST: handle_ST,
+        IRET: handle_IRET,
+        JMP: handle_JMP,
+        PRA: handle_PRA,
+        NOP: handle_NOP,
+        LD: handle_LD,
+        JLT: handle_JLT,
+        JNE: handle_JNE,
+        JEQ: handle_JEQ,
+        JGE: handle_JGE,
+        JGT: handle_JGT,
+        JLE: handle_JLE,
+        INT: handle_INT,
+    }
+
+    # Every ALU opcode, with its handler
+    alutable = {
+        ADD: handle_ADD,
+        SUB: handle_SUB,
+        MUL: handle_MUL,
+        DIV: handle_DIV,
+        MOD: handle_MOD,
+        INC: handle_INC,
+        DEC: handle_DEC,
+        CMP: handle_CMP,
+        AND: handle_AND,
+        NOT: handle_NOT,
+        OR: handle_OR,
+        XOR: handle_XOR,
+        SHL: handle_SHL,
+        SHR: handle_SHR,
+    }
+    handlers.update(alutable)
+
+    # The decode table built from `handlers`, shared by every CPU whose
+    # branchtable was never used; see build_decode()
+    shared_decode = None
 
     def load(self):
-        """Load a program into memory."""
-        path = sys.argv[1]
-
-        address = 0
-
-        with open(path) as file:
-            for line in file:
-                if line[0] != "#" and line !='\n':
-                    self.ram[address] = int(line[:8], 2)
-                    address += 1
-
-    def alu(self, op, reg_a, reg_b):
-        """ALU operations."""
-        # Can set up ALU branchtable
-        if op == "ADD":
-            self.register[reg_a] += self.register[reg_b]
-        elif op == "MUL":
-            self.register[reg_a] *= self.register[reg_b]
-            #elif op == "SUB": etc
-        elif op =="CMP":
-            if self.register[reg_a] < self.register[reg_b]:
-                self.FL = self.less_than
-
-            elif self.register[reg_a] == self.register[reg_b]:
-                self.FL = self.equal_to
-
-            elif self.register[reg_a] > self.register[reg_b]:
-                self.FL = self.greater_than
-        else:
+        """
+        Load the program named on the command line into memory.
+        """
+        self.load_file(sys.argv[1])
+
+    def load_file(self, path):
+        """
+        Load a program file into memory.
+
+        The file can be a .ls8 text file or a binary image; text files are
+        parsed once and then loaded from the image cache.
+        """
+        self.load_bytes(image.read_program(path))
+
+    def reset(self):
+        '''
+        Put the CPU back in its power-on state: registers, flags, PC,
+        interrupts, RAM and extended memory cleared, SP at 0xF4 and the cycle
+        count at zero. Devices and the branchtable are kept.
+        '''
+        self.register[:] = bytes(len(self.register))
+        self.register[self.sp] = 0xF4
+        self.FL = 0
+        self.pc = 0
+        self.interrupts_enabled = True
+        self.update_interrupts()
+        self.ram[:] = bytes(len(self.ram))
+        self.dirty[:] = b"\x01" * len(self.dirty)
+        if self.keyboard is not None:
+            self.keyboard.key = 0
+        if self.banks is not None:
+            self.banks.memory[:] = bytes(len(self.banks.memory))
+            self.banks.dirty[:] = b"\x01" * self.banks.count
+            self.banks.bank = 0
+        self.cycles = 0
+        self.skipped = 0
+        self.timer_started = False
+        if self.code:
+            self.build_code()
+        if self.translator is not None:
+            self.translator.reset()
+
+    def load_bytes(self, program):
+        """
+        Load program bytes, or a binary image such as asm.assemble() output
+        packed with image.pack(), into memory at address 0.
+
+        The CPU is reset() first, so a program can be loaded into a CPU that
+        already ran another one.
+
+        With extended memory, bytes past the end of RAM fill extended memory
+        from bank 0 on, and bank 0 is selected; see asm.py's BANK directive.
+        """
+        if program[:len(image.MAGIC)] == image.MAGIC:
+            program = image.unpack(program)[0]
+        if len(program) > len(self.ram):
+            extended = len(self.banks.memory) if self.banks is not None else 0
+            if len(program) > len(self.ram) + extended:
+                raise ValueError(f"Program is {len(program)} bytes, RAM is {len(self.ram)}"
+                                 f" and extended memory {extended}")
+        self.reset()
+        self.ram[:len(program)] = program[:len(self.ram)]
+        if len(program) > len(self.ram):
+            self.banks.load(program[len(self.ram):])
+
+    def alu(self, op, reg_a, reg_b=0):
+        """
+        ALU operations, keyed by opcode.
+
+        The decode table already sends each ALU opcode straight to its
+        handler; this is for callers that have an opcode in hand.
+        """
+        try:
+            handler = self.alutable[op]
+        except KeyError:
             raise Exception("Unsupported ALU operation")
+        if op >> 6 == 2:
+            handler(self, reg_a, reg_b)
+        else:
+            handler(self, reg_a)
 
     def trace(self):
         """
@@ -486,24 +932,780 @@ class CPU:
 
         print()
 
-    def run(self):
-        """Run the CPU."""
-        self.init_time = time.time()
-        while True:
+    def tick(self, retired):
+        '''
+        Housekeeping done between slices of instructions rather than before
+        every one: count retired instructions, let the timer fire and pick up
+        key presses.
+        '''
+        self.cycles += retired
+
+        if self.timer.tick(retired):
+            # R6 is reserved for the interrupt_status
+            self.register[self.interrupt_status] |= 0b00000001
+            self.update_interrupts()
+
+        if self.keyboard.keys:
             self.kbfunc()
-            if self.interrupts_enabled:
+
+        # Let output show up promptly if a person may be watching
+        if self.console.interactive or self.keyboard.live:
+            self.console.flush()
+
+        if self.profiler is not None:
+            self.profiler.sample(retired)
+
+        # Limits of the current run() call
+        if self.stop_cycles is not None and self.cycles >= self.stop_cycles:
+            raise Stop("cycles")
+        if self.stop_time is not None and time.monotonic() >= self.stop_time:
+            raise Stop("timeout")
+
+    def budget(self):
+        '''
+        Number of instructions to run before calling tick() again: the
+        timer's slice, cut short so that a max_cycles limit is hit exactly.
+        '''
+        count = self.timer.budget()
+        if self.stop_cycles is not None and count > self.stop_cycles - self.cycles:
+            count = self.stop_cycles - self.cycles
+        return count
+
+    def fused_CMP_Jcc(self, operand_a, operand_b, reg, mask, when_set, next_pc):
+        '''
+        CMP followed by a conditional jump.
+        '''
+        a = self.register[operand_a]
+        b = self.register[operand_b]
+        if a < b:
+            self.FL = self.less_than
+        elif a > b:
+            self.FL = self.greater_than
+        else:
+            self.FL = self.equal_to
+        if bool(self.FL & mask) == when_set:
+            self.pc = self.register[reg]
+        else:
+            self.pc = next_pc
+
+    def fused_LDI_JMP(self, reg, num):
+        '''
+        LDI Rx,address followed by JMP Rx.
+        '''
+        self.register[reg] = num
+        self.pc = num
+
+    def fused_LDI_CALL(self, reg, num, return_address):
+        '''
+        LDI Rx,address followed by CALL Rx.
+        '''
+        self.register[reg] = num
+        self.register[self.sp] = (self.register[self.sp] - 1) & 0xFF
+        self.pc = num
+        self.ram_write(return_address, self.register[self.sp])
+
+    def fused_step_CMP(self, reg, step, operand_a, operand_b):
+        '''
+        INC or DEC (step 1 or 0xFF) followed by CMP.
+        '''
+        self.register[reg] = (self.register[reg] + step) & 0xFF
+        a = self.register[operand_a]
+        b = self.register[operand_b]
+        if a < b:
+            self.FL = self.less_than
+        elif a > b:
+            self.FL = self.greater_than
+        else:
+            self.FL = self.equal_to
+
+    def idle_JMP(self, reg, pc):
+        '''
+        JMP at pc. Raises Idle instead of jumping back to itself while an
+        interrupt can wake the program.
+        '''
+        target = self.register[reg]
+        if target == pc and self.interrupts_enabled and self.register[self.interrupt_mask] & WAKE_INTERRUPTS:
+            raise Idle()
+        self.pc = target
+
+    def idle_Jcc(self, reg, mask, when_set, pc):
+        '''
+        Conditional jump at pc. A taken jump to itself is an idle loop too,
+        as nothing in it can change FL.
+        '''
+        if bool(self.FL & mask) == when_set:
+            target = self.register[reg]
+            if target == pc and self.interrupts_enabled and self.register[self.interrupt_mask] & WAKE_INTERRUPTS:
+                raise Idle()
+            self.pc = target
+        else:
+            self.pc = (pc + 2) & 0xFF
+
+    def idle(self, retired, count):
+        '''
+        Called when the program spins in a jump to itself waiting for an
+        interrupt, retired instructions into a slice of count. Returns the
+        number of instructions the slice retires.
+
+        The rest of the slice is skipped rather than run, which changes
+        nothing with a virtual timer. A wall-clock timer that isn't due yet
+        is waited for first, sleeping until it is, a key arrives or run()'s
+        timeout passes, and the instructions the loop would have run
+        meanwhile are counted too. Everything counted without being run is
+        added to `skipped`. With idle_sleep False, run() returns with reason
+        "idle" instead of sleeping, for callers waiting on their own event
+        loop.
+        '''
+        timer = self.timer
+        keyboard = self.keyboard
+        if timer.instructions is None and not keyboard.keys and not timer.due():
+            if not self.idle_sleep:
+                self.tick(retired)
+                raise Stop("idle")
+
+            if self.console.interactive or keyboard.live:
+                self.console.flush()
+            # Clear before checking, so a key queued in between still wakes us
+            keyboard.arrived.clear()
+            if not keyboard.keys:
+                count += timer.wait(keyboard.arrived, self.stop_time)
+                if self.stop_cycles is not None and count > self.stop_cycles - self.cycles:
+                    count = self.stop_cycles - self.cycles
+        self.skipped += count - retired
+        return count
+
+    def native(self, IR):
+        '''
+        True if opcode IR decodes to this CPU's own handler, not a wrapper
+        such as the profiler's. Only those are fused.
+        '''
+        return self.decode[IR][0] is self.handlers.get(IR)
+
+    def fuse(self, pc, IR, operands):
+        '''
+        Return a fused cache entry for the instruction at pc and the one
+        after it, or None if they aren't a fusable pair.
+
+        The first instruction of a pair never writes IM, IS or SP, so no
+        interrupt can become pending between the two.
+        '''
+        if IR not in (CMP, LDI, INC, DEC):
+            return None
+        ram = self.ram
+        second = pc + (IR >> 6) + 1
+        if second + 3 > len(ram) or second == self.until_pc:
+            return None
+        IR2 = ram[second]
+        reg = ram[second + 1]
+        if not (self.native(IR) and self.native(IR2)):
+            return None
+        # A register past R7 in the second instruction makes it raise, which
+        # must come after the first has retired
+        if reg > 7 or (IR2 >> 6 == 2 and ram[second + 2] > 7):
+            return None
+
+        if IR == CMP and IR2 in JUMP_CONDITIONS:
+            mask, when_set = JUMP_CONDITIONS[IR2]
+            run = functools.partial(self.fused_CMP_Jcc, operands[0], operands[1],
+                                    reg, mask, when_set, (second + 2) & 0xFF)
+            entry = (run, 0, 1, 2)
+        elif IR == LDI and operands[0] < 5 and IR2 in (JMP, CALL) and reg == operands[0]:
+            if IR2 == JMP:
+                run = functools.partial(self.fused_LDI_JMP, reg, operands[1])
+            else:
+                run = functools.partial(self.fused_LDI_CALL, reg, operands[1], (second + 2) & 0xFF)
+            entry = (run, 0, 1, 2)
+        elif IR in (INC, DEC) and operands[0] < 5 and IR2 == CMP:
+            run = functools.partial(self.fused_step_CMP, operands[0], 1 if IR == INC else 0xFF,
+                                    reg, ram[second + 2])
+            entry = (run, 5, 0, 2)
+        else:
+            return None
+
+        length = (IR2 >> 6) + 1
+        self.code_cover[second:second + length] = b"\x01" * length
+        return entry
+
+    def predecode(self, pc):
+        '''
+        Decode the instruction at pc, fused with the next one if possible,
+        into an instruction cache entry.
+        '''
+        ram = self.ram
+        check_instruction(ram, pc)
+        IR = ram[pc]
+        handler, size, sets_pc = self.decode[IR]
+        operands = ram[pc + 1:pc + size]
+        self.code_cover[pc:pc + size] = b"\x01" * size
+
+        entry = self.fuse(pc, IR, operands)
+        if entry is not None:
+            return entry
+        if IR == JMP and self.native(IR):
+            return (functools.partial(self.idle_JMP, operands[0], pc), size, sets_pc, 1)
+        if IR in JUMP_CONDITIONS and self.native(IR):
+            mask, when_set = JUMP_CONDITIONS[IR]
+            return (functools.partial(self.idle_Jcc, operands[0], mask, when_set, pc), size, sets_pc, 1)
+        return (functools.partial(handler, self, *operands), size, sets_pc, 1)
+
+    def decode_here(self):
+        '''
+        Runs for every address that hasn't been decoded yet (all of them
+        share the one `miss` entry): decode the instruction at PC into the
+        cache, then run it. The until_pc address is never decoded, so the run
+        loop stops there.
+        '''
+        pc = self.pc
+        if pc == self.until_pc:
+            raise Stop("until_pc")
+        self.code[pc] = self.predecode(pc)
+        self.execute()
+
+    def build_code(self):
+        '''
+        Empty the instruction cache, for a new run or after RAM was replaced.
+        '''
+        if self.miss is None:
+            self.miss = (self.decode_here, 1, 1, 1)
+            # Translated blocks hold on to code_cover, so it is only replaced
+            # before the first run
+            self.code_cover = bytearray(len(self.ram))
+        self.code[:] = [self.miss] * len(self.ram)
+        self.code_cover[:] = bytes(len(self.code_cover))
+
+    def forget(self, address):
+        '''
+        Drop the cache entries that were decoded from address.
+        '''
+        for pc in range(max(0, address - MAX_FUSED_LENGTH + 1), address + 1):
+            self.code[pc] = self.miss
+
+    @property
+    def branchtable(self):
+        '''
+        Opcode -> handler, with the CPU's own handlers bound to it. Change it
+        to add or replace instructions. It is made the first time it is used,
+        from `handlers`.
+        '''
+        if self.own_branchtable is None:
+            self.own_branchtable = BranchTable(
+                (IR, handler.__get__(self)) for IR, handler in self.handlers.items())
+        return self.own_branchtable
+
+    def build_decode(self):
+        '''
+        Build the 256-entry decode table from the branchtable.
+
+        Each entry is (handler, instruction size, sets PC). The operand count
+        comes from bits 6-7 of the opcode and the "sets PC" flag from bit 4,
+        so handlers only get their operands and the run loop advances PC for
+        every instruction that doesn't set it. Handlers are called with the
+        CPU first: the CPU's own are kept as plain functions, and any other
+        is wrapped by call_handler(). Opcodes missing from the branchtable
+        decode to handle_unknown.
+
+        A CPU whose branchtable was never used gets the table built from
+        `handlers`, which all of them share.
+        '''
+        table = self.own_branchtable
+        if table is None:
+            cls = type(self)
+            if cls.shared_decode is None:
+                cls.shared_decode = cls.decode_table(cls.handlers)
+            self.decode = cls.shared_decode
+            self.decoded_version = None
+            return
+
+        handlers = {}
+        for IR, handler in table.items():
+            if getattr(handler, "__self__", None) is self:
+                handlers[IR] = handler.__func__
+            else:
+                handlers[IR] = functools.partial(call_handler, handler)
+        self.decode = self.decode_table(handlers)
+        self.decoded_version = table.version
+
+    @classmethod
+    def decode_table(cls, handlers):
+        '''
+        Return the decode table for the opcode -> handler dict handlers.
+        '''
+        # Opcodes with the same handler and shape share one entry
+        entries = {}
+        decode = []
+        for IR in range(256):
+            entry = (handlers.get(IR, cls.handle_unknown), (IR >> 6) + 1, (IR >> 4) & 1)
+            decode.append(entries.setdefault(entry, entry))
+        return decode
+
+    def execute(self):
+        '''
+        Decode and execute the single instruction at PC, raising
+        InvalidInstruction if it can't run.
+        '''
+        ram = self.ram
+        pc = self.pc
+        IR = ram[pc]
+        handler, size, sets_pc = self.decode[IR]
+        if size == 3:
+            if (pc + 3 > len(ram) or ram[pc + 1] > FIRST_OPERAND_LIMIT[IR]
+                    or ram[pc + 2] > SECOND_OPERAND_LIMIT[IR]):
+                check_instruction(ram, pc)
+            handler(self, ram[pc + 1], ram[pc + 2])
+        elif size == 2:
+            if pc + 2 > len(ram) or ram[pc + 1] > FIRST_OPERAND_LIMIT[IR]:
+                check_instruction(ram, pc)
+            handler(self, ram[pc + 1])
+        else:
+            handler(self)
+        if not sets_pc:
+            self.pc = (pc + size) & 0xFF
+
+    def run(self, max_cycles=None, until_pc=None, timeout=None):
+        """
+        Run the CPU until the program halts or one of the limits is reached,
+        and return a RunResult.
+
+        max_cycles stops it after that many instructions and timeout after
+        that many seconds, checked between slices. until_pc stops it before
+        the instruction at that address runs, straight away if PC is already
+        there. Calling run() again carries on from where it stopped. An
+        instruction that can't run, an unknown opcode or one naming a
+        register past R7, stops it with reason "invalid" before it retires,
+        with the InvalidInstruction as the result's error.
+
+        Instructions run in slices sized by the timer; tick() is called after
+        each slice. Buffered console output is flushed however the run ends.
+        When HLT stops it mid-slice, cycles still counts every instruction
+        retired up to and including the HLT.
+
+        A jump to itself, which programs park in while they wait for
+        interrupts, isn't spun in; see idle().
+
+        With a profiler attached, slices are cut at its sampling period, or
+        run_instrumented() runs with the profiler's hooks if it counts every
+        instruction. With a tracer attached it runs with the tracer's hooks
+        instead, and with a debugger armed, the debugger's; that loop doesn't
+        skip idle loops. The translate engine runs blocks unless until_pc is
+        given, as a block could run past it.
+        """
+        self.prepare()
+
+        start = self.cycles
+        if max_cycles is not None:
+            self.stop_cycles = start + max_cycles
+        if timeout is not None:
+            self.stop_time = time.monotonic() + timeout
+        if until_pc is not None:
+            self.until_pc = until_pc
+            # Leave it undecoded and not fused into the instruction before it
+            self.forget(until_pc)
+
+        error = None
+        try:
+            self.run_interpreted()
+        except Halt:
+            reason = "halt"
+        except Stop as e:
+            reason = e.reason
+        except InvalidInstruction as e:
+            reason = "invalid"
+            error = e.with_traceback(None)
+        finally:
+            self.console.flush()
+            self.stop_cycles = None
+            self.stop_time = None
+            if until_pc is not None:
+                self.until_pc = None
+                self.forget(until_pc)
+        return RunResult(reason, self.cycles - start, self.pc, error)
+
+    def step(self, count=1):
+        """
+        Run count instructions, or fewer if the program halts first, and
+        return a RunResult, as run(max_cycles=count) does.
+
+        A single step skips run()'s slicing and just runs the next
+        instruction and a tick(), unless a profiler, tracer or armed
+        debugger needs its own loop.
+        """
+        if (count != 1 or self.profiler is not None or self.tracer is not None
+                or (self.debugger is not None and self.debugger.armed)):
+            return self.run(max_cycles=count)
+
+        self.prepare()
+        start = self.cycles
+        reason = "cycles"
+        error = None
+        try:
+            if self.interrupt_pending:
                 self.handle_interrupt()
-            IR = self.ram[self.pc]
-            self.branchtable[IR]()
+            self.execute()
+            self.tick(1)
+        except Halt:
+            self.cycles += 1
+            reason = "halt"
+        except InvalidInstruction as e:
+            reason = "invalid"
+            error = e.with_traceback(None)
+        finally:
+            self.console.flush()
+        return RunResult(reason, self.cycles - start, self.pc, error)
+
+    def prepare(self):
+        """
+        Setup shared by run() and step(): build the decode table if the
+        branchtable changed since it was built and the instruction cache if
+        it is empty, and on the first run attach the default keyboard and
+        start the timer.
+        """
+        table = self.own_branchtable
+        version = table.version if table is not None else None
+        if self.decode is None or self.decoded_version != version:
+            self.build_decode()
+            self.build_code()
+        elif not self.code:
+            self.build_code()
+        if self.keyboard is None:
+            self.keyboard = Keyboard()
+            self.keyboard.attach(self)
+        if not self.timer_started:
+            self.timer.start()
+            self.timer_started = True
+
+    def run_interpreted(self):
+        """
+        The loop behind run(). Only returns by raising Halt, Stop or an error.
+        """
+        limit = None
+        if self.debugger is not None and self.debugger.armed:
+            self.debugger.run()
+        if self.tracer is not None:
+            self.tracer.run()
+        if self.profiler is not None:
+            if self.profiler.period == 1:
+                self.profiler.run()
+            limit = self.profiler.period
+        elif self.translator is not None and self.until_pc is None:
+            self.run_translated()
+
+        # Instructions come from the per-address cache; a fused pair
+        # retires two at once, but only when both fit in the slice
+        code = self.code
+        while True:
+            count = self.budget()
+            if limit is not None and count > limit:
+                count = limit
+            retired = 0
+            try:
+                while retired < count:
+                    if self.interrupt_pending:
+                        self.handle_interrupt()
+                    pc = self.pc
+                    run, size, sets_pc, retires = code[pc]
+                    if retires > count - retired:
+                        self.execute()
+                        retired += 1
+                        continue
+                    run()
+                    if not sets_pc:
+                        self.pc = (pc + size) & 0xFF
+                    retired += retires
+            except Halt:
+                self.cycles += retired + 1
+                raise
+            except Stop:
+                # Reached until_pc part way through the slice
+                self.tick(retired)
+                raise
+            except Idle:
+                count = self.idle(retired, count)
+            except BaseException:
+                # An error: count what ran before the instruction raising it
+                self.cycles += retired
+                raise
+            self.tick(count)
+
+    def run_instrumented(self, before=None, after=None):
+        """
+        The loop behind run() for the profiler, tracer and debugger: it
+        interprets one instruction at a time, calling before(pc) ahead of
+        each one and after(pc) once it has retired, and also after(pc) when
+        an interrupt is entered at pc. Either hook can raise Stop to end the
+        run there; an instruction stopped by before() doesn't run. Only
+        returns by raising Halt, Stop or an error.
+        """
+        execute = self.execute
+        until = self.until_pc
+        while True:
+            count = self.budget()
+            retired = 0
+            try:
+                while retired < count:
+                    if self.interrupt_pending:
+                        pc = self.pc
+                        self.handle_interrupt()
+                        if after is not None:
+                            after(pc)
+                    pc = self.pc
+                    if pc == until:
+                        raise Stop("until_pc")
+                    if before is not None:
+                        before(pc)
+                    execute()
+                    retired += 1
+                    if after is not None:
+                        after(pc)
+            except Halt:
+                self.cycles += retired + 1
+                raise
+            except Stop:
+                self.tick(retired)
+                raise
+            except BaseException:
+                self.cycles += retired
+                raise
+            self.tick(count)
+
+    def run_translated(self):
+        """
+        Run the CPU one translated block at a time.
+
+        Interrupts are checked between blocks. Blocks end after any write to
+        IM or IS, so program-raised interrupts are taken at the same
+        instruction boundary as in the interpreter. A block that doesn't fit
+        in what is left of the timer slice is stepped through by the
+        interpreter instead, so slices retire exactly as many instructions as
+        they would in the interpreter.
+        """
+        translator = self.translator
+        cover = translator.cover
+        invalidate = translator.invalidate
+        dirty = self.dirty
+        while True:
+            budget = self.budget()
+            retired = 0
+            try:
+                while retired < budget:
+                    if self.interrupt_pending:
+                        self.handle_interrupt()
+                    block = translator.lookup(self.pc)
+                    if block is None or block.count > budget - retired:
+                        self.execute()
+                        retired += 1
+                    else:
+                        self.pc = block(self, self.register, self.ram, cover, invalidate, dirty)
+                        retired += block.count
+            except Halt:
+                # Only the interpreter halts, never a block
+                self.cycles += retired + 1
+                raise
+            except Idle:
+                retired = self.idle(retired, budget)
+            except BaseException:
+                # An error: count what ran before the instruction raising it
+                self.cycles += retired
+                raise
+            self.tick(retired)
 
     def ram_read(self, MAR):
         '''
-        Read a value from a given ram index
+        Read a value from a given ram index, or from the device mapped there
         '''
+        if self.device_reads[MAR]:
+            return self.readers[MAR](MAR)
         return self.ram[MAR]
 
+    def map_device(self, start, end, read=None, write=None):
+        '''
+        Map addresses start to end - 1 to a device. Loads from them return
+        read(address) and stores call write(address, value) instead of
+        touching RAM; either can be None to leave that direction to RAM, and
+        both None unmaps the range. Instructions are always fetched from RAM.
+        '''
+        for address in range(start, end):
+            self.readers[address] = read
+            self.writers[address] = write
+            self.device_reads[address] = read is not None
+            self.device_writes[address] = write is not None
+
+    def replaced(self, start, end):
+        '''
+        Account for a device having rewritten RAM from start to end - 1:
+        mark the pages dirty and drop code decoded from there.
+        '''
+        for page in range(start >> PAGE_SHIFT, ((end - 1) >> PAGE_SHIFT) + 1):
+            self.dirty[page] = 1
+        if self.code_cover.find(1, start, end) != -1:
+            for address in range(start, end):
+                if self.code_cover[address]:
+                    self.forget(address)
+        if self.translator is not None:
+            cover = self.translator.cover
+            for address in range(start, end):
+                if cover[address]:
+                    self.translator.invalidate(address)
+
+    def memory(self):
+        '''
+        Return a memoryview of RAM, for inspecting or bulk-loading memory
+        without copying. It shows RAM under mapped devices, not the devices.
+        Writes through it bypass the instruction cache, so load programs with
+        load_bytes() once the CPU has run. Extended memory is banks.memory,
+        up to date after banks.save().
+        '''
+        return memoryview(self.ram)
+
+    def snapshot(self, incremental=False):
+        '''
+        Capture the CPU state as a bytes blob and start a new checkpoint.
+
+        A full snapshot holds all of RAM. An incremental one holds only the RAM
+        pages written (through ram_write, stores, stack operations and
+        interrupts) since the previous snapshot, so restoring it only makes
+        sense on top of that previous snapshot. Extended memory is handled
+        the same way, by whole banks, and only restores into a CPU with as
+        much of it.
+        '''
+        header = SNAPSHOT_HEADER.pack(
+            b"I" if incremental else b"F",
+            self.pc, self.FL, self.interrupts_enabled, self.cycles)
+        parts = [header, bytes(self.register)]
+        banks = self.banks
+        if banks is not None:
+            banks.save()
+            parts.append(SNAPSHOT_BANK.pack(banks.bank))
+            if incremental:
+                changed = []
+                bank = banks.dirty.find(1)
+                while bank != -1:
+                    changed.append(bank)
+                    bank = banks.dirty.find(1, bank + 1)
+                parts.append(SNAPSHOT_COUNT.pack(len(changed)))
+                memory = memoryview(banks.memory)
+                for bank in changed:
+                    start = bank * BANK_SIZE
+                    parts.append(SNAPSHOT_BANK.pack(bank))
+                    parts.append(memory[start:start + BANK_SIZE])
+            else:
+                parts.append(bytes(banks.memory))
+            banks.dirty[:] = bytes(len(banks.dirty))
+
+        if incremental:
+            ram = self.memory()
+            for page, written in enumerate(self.dirty):
+                if written:
+                    start = page << PAGE_SHIFT
+                    parts.append(bytes([page]))
+                    parts.append(ram[start:start + PAGE_SIZE])
+        else:
+            parts.append(bytes(self.ram))
+
+        self.dirty[:] = bytes(len(self.dirty))
+        return b"".join(parts)
+
+    def restore(self, snapshot):
+        '''
+        Put the CPU back in the state captured by snapshot(). RAM and
+        registers are updated in place.
+        '''
+        kind, self.pc, self.FL, enabled, self.cycles = SNAPSHOT_HEADER.unpack_from(snapshot)
+        self.interrupts_enabled = bool(enabled)
+
+        offset = SNAPSHOT_HEADER.size
+        self.register[:] = snapshot[offset:offset + 8]
+        offset += 8
+        self.update_interrupts()
+
+        if self.banks is not None:
+            # The window is restored with the rest of RAM
+            banks = self.banks
+            banks.bank = SNAPSHOT_BANK.unpack_from(snapshot, offset)[0]
+            offset += SNAPSHOT_BANK.size
+            if kind == b"F":
+                size = len(banks.memory)
+                banks.memory[:] = snapshot[offset:offset + size]
+                offset += size
+            else:
+                count = SNAPSHOT_COUNT.unpack_from(snapshot, offset)[0]
+                offset += SNAPSHOT_COUNT.size
+                for _ in range(count):
+                    start = SNAPSHOT_BANK.unpack_from(snapshot, offset)[0] * BANK_SIZE
+                    offset += SNAPSHOT_BANK.size
+                    banks.memory[start:start + BANK_SIZE] = snapshot[offset:offset + BANK_SIZE]
+                    offset += BANK_SIZE
+            banks.dirty[:] = bytes(len(banks.dirty))
+
+        if kind == b"F":
+            self.ram[:] = snapshot[offset:]
+            if self.translator is not None:
+                self.translator.reset()
+        else:
+            while offset < len(snapshot):
+                start = snapshot[offset] << PAGE_SHIFT
+                self.ram[start:start + PAGE_SIZE] = snapshot[offset + 1:offset + 1 + PAGE_SIZE]
+                offset += 1 + PAGE_SIZE
+                if self.translator is not None:
+                    for address in range(start, start + PAGE_SIZE):
+                        if self.translator.cover[address]:
+                            self.translator.invalidate(address)
+
+        self.dirty[:] = bytes(len(self.dirty))
+        if self.code:
+            self.build_code()
+
+    def fork(self, snapshot=None, **devices):
+        '''
+        Return a new CPU running the same engine, started from snapshot (or
+        from this CPU's current state). devices are passed on to the new
+        CPU's constructor; by default it gets its own fresh devices.
+
+        The new CPU shares nothing mutable with this one, and its RAM is filled
+        by one bulk copy, so forking many CPUs off one snapshot is cheap. A
+        CPU with extended memory forks one with the same amount. Custom
+        opcodes are carried over, but not instrumentation attached to this
+        CPU, like a profiler.
+        '''
+        if snapshot is None:
+            # Taking a snapshot would reset this CPU's dirty pages and banks
+            dirty = bytes(self.dirty)
+            if self.banks is not None:
+                banks_dirty = bytes(self.banks.dirty)
+            snapshot = self.snapshot()
+            self.dirty[:] = dirty
+            if self.banks is not None:
+                self.banks.dirty[:] = banks_dirty
+
+        if self.banks is not None and "banks" not in devices:
+            devices["banks"] = Banks(len(self.banks.memory))
+        child = CPU(self.engine, **devices)
+        if self.own_branchtable is not None:
+            child.branchtable.update(
+                (IR, handler) for IR, handler in self.own_branchtable.items()
+                if not self.owns(handler))
+        child.restore(snapshot)
+        return child
+
+    def owns(self, handler):
+        '''
+        True if handler is a method of this CPU or of something attached to
+        it, like a profiler, so it must not be carried over to another CPU.
+        '''
+        owner = getattr(handler, "__self__", None)
+        return owner is self or getattr(owner, "cpu", None) is self
+
     def ram_write(self, MDR, MAR):
         '''
-        Write a value into a given ram index
+        Write a value into a given ram index, or to the device mapped there
+        The page is marked dirty for incremental snapshots
+        Translated blocks covering that address are thrown away
         '''
-        self.ram[MAR] = MDR
\ No newline at end of file
+        if self.device_writes[MAR]:
+            self.writers[MAR](MAR, MDR)
+            return
+        self.ram[MAR] = MDR
+        self.dirty[MAR >> PAGE_SHIFT] = 1
+        if self.code_cover[MAR]:
+            self.forget(MAR)
+        if self.translator is not None and self.translator.cover[MAR]:
+            self.translator.invalidate(MAR)
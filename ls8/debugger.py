@@ -0,0 +1,135 @@
+"""Breakpoints and watchpoints for the LS-8 CPU."""
+
+import collections
+
+from cpu import Stop
+
+# What stopped the program: kind ("breakpoint", "memory" or "register"),
+# the address or register number, and the opcode there, the byte stored or
+# the register's new value
+Hit = collections.namedtuple("Hit", "kind where value")
+
+
+class Debugger:
+    """
+    PC breakpoints, memory watchpoints and register watchpoints.
+
+    Breakpoints and watched addresses are 256-entry flag arrays. While any
+    of them is set the debugger is armed, and CPU.run() swaps in the
+    debugger's instrumented loop; otherwise the CPU runs its normal loops
+    and the debugger costs nothing.
+
+    run() returns with reason "breakpoint" before the instruction at a
+    breakpoint runs, and with reason "watchpoint" after an instruction (or
+    interrupt entry) stores to a watched address or changes a watched
+    register; `hit` says which. cpu.step() single-steps and cpu.run()
+    continues, past the breakpoint it stopped at. A breakpoint at the PC
+    the program starts from stops it before its first instruction.
+
+    Like the profiler's, the debugger's loop interprets one instruction at a
+    time even on the translate engine, and spins through idle loops.
+    """
+
+    def __init__(self, cpu):
+        self.cpu = cpu
+        self.breakpoints = bytearray(len(cpu.ram))
+        self.watched = bytearray(len(cpu.ram))
+        self.registers = []
+        self.armed = False
+        self.hit = None
+        self.write = None
+        # Watched registers' values and the breakpoint to run past, for
+        # the hooks run() passes to the CPU's instrumented loop
+        self.values = []
+        self.resume = None
+        cpu.debugger = self
+
+    def update(self):
+        self.armed = bool(any(self.breakpoints) or any(self.watched) or self.registers)
+
+    def set_breakpoint(self, address, enabled=True):
+        '''
+        Stop before the instruction at address runs.
+        '''
+        self.breakpoints[address] = enabled
+        self.update()
+
+    def watch_memory(self, address, enabled=True):
+        '''
+        Stop after anything stores to address, even the value already there.
+        '''
+        self.watched[address] = enabled
+        self.update()
+
+    def watch_register(self, reg, enabled=True):
+        '''
+        Stop after register reg changes value.
+        '''
+        if enabled and reg not in self.registers:
+            self.registers.append(reg)
+        elif not enabled and reg in self.registers:
+            self.registers.remove(reg)
+        self.update()
+
+    def clear(self):
+        '''
+        Remove every breakpoint and watchpoint.
+        '''
+        self.breakpoints[:] = bytes(len(self.breakpoints))
+        self.watched[:] = bytes(len(self.watched))
+        self.registers.clear()
+        self.update()
+
+    def ram_write(self, MDR, MAR):
+        '''
+        Stands in for cpu.ram_write while the debugger's loop runs, so stores
+        from ST, PUSH, CALL and interrupt entry are all seen.
+        '''
+        self.write(MDR, MAR)
+        if self.watched[MAR] and self.hit is None:
+            self.hit = Hit("memory", MAR, MDR)
+
+    def changed(self, values):
+        '''
+        Record a hit for the first watched register that no longer holds its
+        value in values, and bring values up to date.
+        '''
+        register = self.cpu.register
+        for i, reg in enumerate(self.registers):
+            if register[reg] != values[i]:
+                values[i] = register[reg]
+                if self.hit is None:
+                    self.hit = Hit("register", reg, register[reg])
+
+    def run(self):
+        '''
+        Run the CPU through its instrumented loop, checking breakpoints
+        before every instruction and watchpoints after it and after
+        interrupt entry.
+        '''
+        cpu = self.cpu
+        self.values = [cpu.register[reg] for reg in self.registers]
+        # Continue past the breakpoint the last run() stopped on, if PC is
+        # still there
+        self.resume = None
+        if self.hit is not None and self.hit.kind == "breakpoint":
+            self.resume = self.hit.where
+        self.hit = None
+
+        self.write = cpu.ram_write
+        cpu.ram_write = self.ram_write
+        try:
+            cpu.run_instrumented(before=self.check_breakpoint, after=self.check_watchpoints)
+        finally:
+            del cpu.ram_write
+
+    def check_breakpoint(self, pc):
+        if self.breakpoints[pc] and pc != self.resume:
+            self.hit = Hit("breakpoint", pc, self.cpu.ram[pc])
+            raise Stop("breakpoint")
+        self.resume = None
+
+    def check_watchpoints(self, pc):
+        self.changed(self.values)
+        if self.hit is not None:
+            raise Stop("watchpoint")
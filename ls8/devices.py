@@ -0,0 +1,337 @@
+"""Peripheral devices for the LS-8 CPU."""
+
+import collections
+import io
+import os
+import sys
+import threading
+import time
+
+from terminal import cbreak
+
+
+# Wall-clock timer: how often the deadline should be checked, and the bounds
+# on the number of instructions run between two checks
+CHECKS_PER_SECOND = 1000
+MIN_INTERVAL = 100
+MAX_INTERVAL = 1000000
+
+# Console output is written out once this many bytes are buffered
+CONSOLE_THRESHOLD = 64 * 1024
+
+# Memory-mapped keyboard register holding the last key delivered
+KEY_ADDRESS = 0xF4
+
+# Extended memory: banks of BANK_SIZE bytes show through the window at
+# BANK_START, picked by the 16-bit bank register at BANK_SELECT (low byte)
+# and BANK_SELECT + 1 (high byte)
+BANK_START = 0x80
+BANK_SIZE = 0x40
+BANK_SELECT = 0xF5
+MAX_BANKS = 0x10000
+
+
+class Keyboard:
+    """
+    Keyboard device.
+
+    Key codes are queued on a deque that the CPU drains between instructions.
+    Keys can come from a background thread reading a TTY, pipe or file, or
+    from a scripted byte string given up front.
+
+    The key being handled is latched in `key` and mapped into memory at
+    KEY_ADDRESS, where programs load it from.
+    """
+
+    def __init__(self, source=None):
+        '''
+        source may be None (keys are only added with press()), a str or bytes
+        script, or a file object to read from in the background.
+        '''
+        self.keys = collections.deque()
+        self.key = 0
+        # Set whenever keys are queued, so an idle CPU can sleep until then
+        self.arrived = threading.Event()
+        self.stream = None
+        self.thread = None
+        # True while a reader thread may still deliver keys
+        self.live = False
+
+        if source is None:
+            return
+        if isinstance(source, str):
+            source = source.encode()
+        if isinstance(source, (bytes, bytearray)):
+            self.keys.extend(source)
+        else:
+            self.start(source)
+
+    def start(self, stream):
+        '''
+        Start a daemon thread that feeds every byte read from stream into the
+        key queue. A TTY is switched to cbreak mode first.
+        '''
+        # Keep a reference so the stream isn't closed under the reader thread
+        self.stream = stream
+        fd = stream.fileno()
+        cbreak(fd)
+
+        self.live = True
+        self.thread = threading.Thread(target=self.reader, args=(fd,),
+                                       daemon=True)
+        self.thread.start()
+
+    def reader(self, fd):
+        '''
+        Read from fd until end of file, queueing every byte as a key press.
+        '''
+        while True:
+            try:
+                data = os.read(fd, 4096)
+            except OSError:
+                break
+            if not data:
+                break
+            self.keys.extend(data)
+            self.arrived.set()
+        self.live = False
+
+    def press(self, key):
+        '''
+        Queue a single key code.
+        '''
+        self.keys.append(key & 0xFF)
+        self.arrived.set()
+
+    def attach(self, cpu):
+        '''
+        Map the key register into cpu's memory.
+        '''
+        cpu.map_device(KEY_ADDRESS, KEY_ADDRESS + 1, self.read, self.write)
+
+    def read(self, address):
+        return self.key
+
+    def write(self, address, value):
+        self.key = value
+
+
+class Timer:
+    """
+    Timer device raising interrupt I0.
+
+    In wall-clock mode the timer fires every `period` seconds. The CPU only
+    asks for the time every `interval` instructions; the interval is retuned
+    at each check from the measured instruction rate so that checks happen
+    about CHECKS_PER_SECOND times a second whatever the host speed.
+
+    In virtual mode (`instructions` given) the timer fires every
+    `instructions` retired instructions and never looks at the clock, so runs
+    are fully deterministic.
+    """
+
+    def __init__(self, period=1.0, instructions=None):
+        self.period = period
+        self.instructions = instructions
+        self.interval = 1000
+        self.deadline = 0
+        self.last_check = 0
+        self.remaining = instructions
+
+    def start(self):
+        '''
+        Arm the timer. Called by the CPU when it starts running.
+        '''
+        now = time.monotonic()
+        self.deadline = now + self.period
+        self.last_check = now
+        self.remaining = self.instructions
+
+    def budget(self):
+        '''
+        Number of instructions the CPU may run before calling tick() again.
+        '''
+        if self.instructions is not None:
+            return min(self.remaining, self.interval)
+        return self.interval
+
+    def tick(self, retired):
+        '''
+        Account for `retired` instructions. Returns True if the timer fired.
+        '''
+        if self.instructions is not None:
+            self.remaining -= retired
+            if self.remaining <= 0:
+                self.remaining = self.instructions
+                return True
+            return False
+
+        now = time.monotonic()
+        elapsed = now - self.last_check
+        self.last_check = now
+        if elapsed > 0:
+            interval = int(retired / elapsed / CHECKS_PER_SECOND)
+            self.interval = max(MIN_INTERVAL, min(MAX_INTERVAL, interval))
+
+        if now >= self.deadline:
+            self.deadline = now + self.period
+            return True
+        return False
+
+    def due(self):
+        '''
+        True if a wall-clock timer will fire at the next tick().
+        '''
+        return self.instructions is None and time.monotonic() >= self.deadline
+
+    def wait(self, event=None, until=None):
+        '''
+        Block until the wall-clock timer is due, event is set or
+        time.monotonic() reaches until, whichever comes first. Returns about
+        how many instructions the CPU would have run in the meantime, at the
+        rate the check interval was tuned for.
+        '''
+        start = time.monotonic()
+        end = self.deadline if until is None else min(self.deadline, until)
+        if end > start:
+            if event is not None:
+                event.wait(end - start)
+            else:
+                time.sleep(end - start)
+        return int((time.monotonic() - start) * self.interval * CHECKS_PER_SECOND)
+
+
+class Console:
+    """
+    Output device for PRN and PRA.
+
+    Output is collected in a buffer and handed to the sink in large chunks:
+    when the buffer passes `threshold` bytes, when the CPU stops, and between
+    instruction slices if someone may be watching (the sink is a terminal or
+    the program is waiting on interactive keyboard input).
+
+    The sink can be None for stdout, a bytearray that output is appended to,
+    a binary or text file object, or a callable taking bytes.
+    """
+
+    def __init__(self, sink=None, threshold=CONSOLE_THRESHOLD):
+        self.sink = sink
+        self.threshold = threshold
+        self.buffer = bytearray()
+
+        # Terminal output is flushed between slices so it appears promptly
+        self.interactive = sink is None and sys.stdout.isatty()
+
+    def write(self, data):
+        '''
+        Queue bytes of output.
+        '''
+        self.buffer += data
+        if len(self.buffer) >= self.threshold:
+            self.flush()
+
+    def flush(self):
+        '''
+        Hand everything buffered so far to the sink.
+        '''
+        if not self.buffer:
+            return
+        data = bytes(self.buffer)
+        self.buffer.clear()
+
+        sink = self.sink
+        if sink is None:
+            sink = sys.stdout
+        if isinstance(sink, bytearray):
+            sink += data
+        elif callable(sink):
+            sink(data)
+        elif isinstance(sink, io.TextIOBase):
+            if hasattr(sink, "buffer"):
+                sink.flush()
+                sink.buffer.write(data)
+                sink.buffer.flush()
+            else:
+                sink.write(data.decode())
+        else:
+            sink.write(data)
+
+
+class Banks:
+    """
+    Extended memory, bank-switched into the CPU's 256-byte address space.
+
+    All `size` bytes live in one bytearray, `memory`, as banks of BANK_SIZE
+    bytes. The selected bank shows through the window at BANK_START:
+    selecting another copies the window back to its bank and the new bank
+    in, so loads, stores and instruction fetches in the window cost the same
+    as anywhere else in RAM. Until the next switch or save(), the selected
+    bank's bytes in `memory` are stale.
+
+    `dirty` flags the banks whose bytes changed since the CPU's last
+    snapshot, for incremental snapshots.
+    """
+
+    def __init__(self, size=65536):
+        if size <= 0 or size % BANK_SIZE or size // BANK_SIZE > MAX_BANKS:
+            raise ValueError(f"Extended memory must be a multiple of {BANK_SIZE} bytes, "
+                             f"at most {MAX_BANKS * BANK_SIZE}")
+        self.memory = bytearray(size)
+        self.count = size // BANK_SIZE
+        self.dirty = bytearray(self.count)
+        self.bank = 0
+        self.cpu = None
+
+    def attach(self, cpu):
+        '''
+        Map the bank register into cpu's memory.
+        '''
+        self.cpu = cpu
+        cpu.map_device(BANK_SELECT, BANK_SELECT + 2, self.read, self.write)
+
+    def read(self, address):
+        return (self.bank >> 8 * (address - BANK_SELECT)) & 0xFF
+
+    def write(self, address, value):
+        shift = 8 * (address - BANK_SELECT)
+        self.select((self.bank & ~(0xFF << shift)) | (value << shift))
+
+    def select(self, bank):
+        '''
+        Switch the window to bank, wrapping past the last one.
+        '''
+        bank %= self.count
+        if bank == self.bank:
+            return
+        self.save()
+        self.bank = bank
+        self.show()
+
+    def save(self):
+        '''
+        Copy the window back into the selected bank, flagging the bank dirty
+        if that changes it.
+        '''
+        start = self.bank * BANK_SIZE
+        window = self.cpu.ram[BANK_START:BANK_START + BANK_SIZE]
+        if self.memory[start:start + BANK_SIZE] != window:
+            self.memory[start:start + BANK_SIZE] = window
+            self.dirty[self.bank] = 1
+
+    def show(self):
+        '''
+        Copy the selected bank into the window.
+        '''
+        start = self.bank * BANK_SIZE
+        self.cpu.ram[BANK_START:BANK_START + BANK_SIZE] = self.memory[start:start + BANK_SIZE]
+        self.cpu.replaced(BANK_START, BANK_START + BANK_SIZE)
+
+    def load(self, data):
+        '''
+        Fill memory from its start with data and select bank 0.
+        '''
+        self.memory[:len(data)] = data
+        touched = (len(data) + BANK_SIZE - 1) // BANK_SIZE
+        self.dirty[:touched] = b"\x01" * touched
+        self.bank = 0
+        self.show()
@@ -0,0 +1,125 @@
+"""Binary program images for the LS-8 and a cache of parsed .ls8 files."""
+
+import hashlib
+import os
+import struct
+import tempfile
+
+# Image layout, all little-endian:
+#
+#   magic          4s  b"LS8I"
+#   version        B   1
+#   flags          B   reserved, 0
+#   symbol count   H
+#   image length   I   bytes of memory image that follow
+#   image          image length bytes, loaded at address 0
+#   symbols        symbol count times: name length (B), name, address (H)
+#
+# asm/asm.py --binary writes the same layout.
+MAGIC = b"LS8I"
+VERSION = 1
+HEADER = struct.Struct("<4sBBHI")
+SYMBOL = struct.Struct("<H")
+
+# Parsed .ls8 files are cached here as binary images named by content hash
+CACHE_DIR = os.environ.get("LS8_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "ls8"))
+
+
+def pack(image, symbols=None):
+    '''
+    Build a binary image from program bytes and an optional {name: address}
+    symbol table.
+    '''
+    symbols = symbols or {}
+    parts = [HEADER.pack(MAGIC, VERSION, 0, len(symbols), len(image)), bytes(image)]
+    for name, address in symbols.items():
+        encoded = name.encode()
+        parts.append(bytes([len(encoded)]) + encoded + SYMBOL.pack(address))
+    return b"".join(parts)
+
+
+def unpack(data):
+    '''
+    Split a binary image into (program bytes, {name: address}).
+    '''
+    magic, version, flags, symbol_count, length = HEADER.unpack_from(data, 0)
+    if magic != MAGIC:
+        raise ValueError("Not an LS-8 binary image")
+    if version != VERSION:
+        raise ValueError(f"Unsupported LS-8 image version {version}")
+
+    offset = HEADER.size
+    image = bytes(data[offset:offset + length])
+    offset += length
+
+    symbols = {}
+    for _ in range(symbol_count):
+        size = data[offset]
+        name = bytes(data[offset + 1:offset + 1 + size]).decode()
+        offset += 1 + size
+        symbols[name] = SYMBOL.unpack_from(data, offset)[0]
+        offset += SYMBOL.size
+
+    return image, symbols
+
+
+def parse_text(text):
+    '''
+    Parse the textual .ls8 format: one binary byte per line, "#" comments
+    and blank lines ignored.
+    '''
+    image = bytearray()
+    for line in text.splitlines():
+        line = line.split("#", 1)[0].strip()
+        if line:
+            image.append(int(line, 2))
+    return bytes(image)
+
+
+def cache_path(data):
+    '''
+    Where the binary image for .ls8 text `data` is cached.
+    '''
+    return os.path.join(CACHE_DIR, hashlib.sha256(data).hexdigest() + ".ls8b")
+
+
+def read_program(path, cache=True):
+    '''
+    Read a program from a binary image or a .ls8 text file and return its
+    bytes. Text files are converted once and then served from the cache,
+    keyed by the hash of their contents.
+    '''
+    with open(path, "rb") as file:
+        return program_bytes(file.read(), cache)
+
+
+def program_bytes(data, cache=True):
+    '''
+    Return the program in data, the contents of a binary image or of a .ls8
+    text file, using the same cache as read_program().
+    '''
+    if data[:len(MAGIC)] == MAGIC:
+        return unpack(data)[0]
+
+    if not cache:
+        return parse_text(data.decode())
+
+    cached = cache_path(data)
+    try:
+        with open(cached, "rb") as file:
+            return unpack(file.read())[0]
+    except (OSError, ValueError, struct.error):
+        pass
+
+    image = parse_text(data.decode())
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        # Write under a temporary name so a concurrent reader never sees half an image
+        fd, temporary = tempfile.mkstemp(dir=CACHE_DIR)
+        with os.fdopen(fd, "wb") as file:
+            file.write(pack(image))
+        os.replace(temporary, cached)
+    except OSError:
+        # A read-only or missing cache only costs speed
+        pass
+    return image
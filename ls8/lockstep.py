@@ -0,0 +1,519 @@
+#!/usr/bin/env python3
+
+"""
+Lockstep engine: many LS-8 machines executed together with NumPy.
+
+Every machine (lane) has its own RAM, registers, PC and FL, held as rows of
+(N, 256), (N, 8) and (N,) arrays. Each step runs one instruction on every
+running lane: lanes are grouped by the opcode at their PC and each group is
+updated with one set of array operations. This needs numpy.
+
+Lanes model a CPU with no key presses and no extended memory. The keyboard
+register at 0xF4 is mapped as on CPU: loads see 0 or the last value stored
+there, and only instruction fetches see the RAM byte beneath it. The bank
+select register (0xF5-0xF6) and the bank window (0x80-0xBF) are plain RAM,
+as on a CPU created without banks; programs larger than RAM are refused.
+
+    python lockstep.py examples/*.ls8 --virtual-timer 10000 --check
+"""
+
+import argparse
+import sys
+
+import numpy as np
+
+import image
+from cpu import (
+    ADD, SUB, MUL, DIV, MOD, INC, DEC, CMP, AND, NOT, OR, XOR, SHL, SHR,
+    CALL, RET, INT, IRET, JMP, JEQ, JNE, JGT, JLT, JLE, JGE,
+    NOP, HLT, LDI, LD, ST, PUSH, POP, PRN, PRA,
+    FIRST_OPERAND_LIMIT, SECOND_OPERAND_LIMIT, InvalidInstruction, check_instruction,
+)
+from devices import KEY_ADDRESS
+
+IM = 5
+IS = 6
+SP = 7
+
+# Two-register ALU ops and the new value of registerA, on int arrays
+ALU_OPERATIONS = {
+    ADD: lambda x, y: (x + y) & 0xFF,
+    SUB: lambda x, y: (x - y) & 0xFF,
+    MUL: lambda x, y: (x * y) & 0xFF,
+    AND: lambda x, y: x & y,
+    OR: lambda x, y: x | y,
+    XOR: lambda x, y: x ^ y,
+    SHL: lambda x, y: (x << np.minimum(y, 8)) & 0xFF,
+    SHR: lambda x, y: x >> np.minimum(y, 8),
+}
+
+# Single-bit value -> bit number, for picking the interrupt vector
+LOWEST_BIT = np.zeros(256, dtype=np.intp)
+for _bit in range(8):
+    LOWEST_BIT[1 << _bit] = _bit
+
+# FL bits that make each conditional jump taken
+CONDITIONS = {
+    JEQ: 0b00000001,
+    JGT: 0b00000010,
+    JLT: 0b00000100,
+    JLE: 0b00000101,
+    JGE: 0b00000011,
+}
+
+# Per opcode: how far PC moves past it (0 for instructions that set PC)
+ADVANCE = np.array([0 if (IR >> 4) & 1 else (IR >> 6) + 1 for IR in range(256)], dtype=np.uint8)
+
+# What a print leaves in a lane's output, by register value. PRA adds a
+# newline while interrupts are disabled, the same quirk as CPU.handle_PRA.
+PRN_TEXT = np.array([b"%d\n" % value for value in range(256)], dtype=object)
+PRA_TEXT = np.array([[(chr(value) + "\n").encode() for value in range(256)],
+                     [chr(value).encode() for value in range(256)]], dtype=object)
+
+
+class Lockstep:
+    """
+    N LS-8 machines run in lockstep, one per program in `programs`.
+
+    Machines start as a fresh CPU does. Each lane's output is collected in
+    output[lane]. A lane stops on HLT (reason "halt"), on an instruction
+    CPU finds invalid ("invalid", with the message in errors[lane]) or when
+    run() reaches its cycle budget ("cycles").
+
+    Prints are queued by step() and appended to output by flush(), which
+    run() calls before returning.
+
+    There are no key presses, but the keyboard register is mapped at
+    KEY_ADDRESS: ram holds the register there, and the RAM byte under it,
+    which only instruction fetches see, is kept in under_key. The timer only
+    exists in virtual mode: with
+    virtual_timer=K it fires on every lane after each K instructions, which
+    is what CPU does with Timer(instructions=K).
+    """
+
+    def __init__(self, programs, virtual_timer=None):
+        n = len(programs)
+        self.ram = np.zeros((n, 256), dtype=np.uint8)
+        self.register = np.zeros((n, 8), dtype=np.uint8)
+        self.register[:, SP] = 0xF4
+        # Flat views, indexed by lane * 256 + address and lane * 8 + register
+        self.flat_ram = self.ram.reshape(-1)
+        self.flat_register = self.register.reshape(-1)
+        self.pc = np.zeros(n, dtype=np.uint8)
+        self.FL = np.zeros(n, dtype=np.uint8)
+        self.interrupts_enabled = np.ones(n, dtype=bool)
+        self.running = np.ones(n, dtype=bool)
+        # Every running lane retires one instruction per step, so cycles is
+        # filled in from steps when a lane stops, and by flush()
+        self.cycles = np.zeros(n, dtype=np.int64)
+        self.steps = 0
+        # Running lanes and the start of their RAM in flat_ram, kept until a
+        # lane stops
+        self.lanes = None
+        self.base = None
+        self.virtual_timer = virtual_timer
+
+        self.output = [bytearray() for _ in range(n)]
+        # (lanes, texts) pairs printed since the last flush()
+        self.printed = []
+        self.reasons = np.full(n, None, dtype=object)
+        self.errors = np.full(n, None, dtype=object)
+
+        for lane, program in enumerate(programs):
+            if len(program) > 256:
+                raise ValueError(f"Program is {len(program)} bytes, RAM is 256")
+            self.ram[lane, :len(program)] = np.frombuffer(bytes(program), dtype=np.uint8)
+        # The keyboard register starts at 0, as a Keyboard's key does
+        self.under_key = self.ram[:, KEY_ADDRESS].copy()
+        self.ram[:, KEY_ADDRESS] = 0
+
+        self.branchtable = {
+            LDI: self.handle_LDI,
+            LD: self.handle_LD,
+            ST: self.handle_ST,
+            PUSH: self.handle_PUSH,
+            POP: self.handle_POP,
+            PRN: self.handle_PRN,
+            PRA: self.handle_PRA,
+            INC: self.handle_INC,
+            DEC: self.handle_DEC,
+            NOT: self.handle_NOT,
+            DIV: self.handle_DIV,
+            MOD: self.handle_MOD,
+            CMP: self.handle_CMP,
+            CALL: self.handle_CALL,
+            RET: self.handle_RET,
+            INT: self.handle_INT,
+            IRET: self.handle_IRET,
+            JMP: self.handle_JMP,
+            JNE: self.handle_JNE,
+            HLT: self.handle_HLT,
+            NOP: self.handle_NOP,
+        }
+        for IR in ALU_OPERATIONS:
+            self.branchtable[IR] = self.handle_alu
+        for IR in CONDITIONS:
+            self.branchtable[IR] = self.handle_jump_if
+
+    @classmethod
+    def replicate(cls, program, n, virtual_timer=None):
+        '''
+        N lanes all running the same program.
+        '''
+        return cls([program] * n, virtual_timer)
+
+    def retire(self, lanes, reason, error=None):
+        self.running[lanes] = False
+        self.lanes = None
+        self.reasons[lanes] = reason
+        self.cycles[lanes] = self.steps
+        if reason == "invalid":
+            # As on CPU, the instruction that failed didn't retire
+            self.cycles[lanes] -= 1
+            self.errors[lanes] = error
+
+    def fail(self, lanes, pc, error):
+        '''
+        Stop lanes whose instruction at pc is invalid, with error as the
+        message. PC stays on the instruction, as it does on CPU.
+        '''
+        self.pc[lanes] = pc
+        self.retire(lanes, "invalid", error)
+
+    def print(self, lanes, texts):
+        self.printed.append((lanes, texts))
+
+    def flush(self):
+        '''
+        Append everything printed since the last flush to each lane's output,
+        and bring cycles up to date for lanes still running.
+        '''
+        self.cycles[self.running] = self.steps
+        if not self.printed:
+            return
+        lanes = np.concatenate([lanes for lanes, _ in self.printed])
+        texts = np.concatenate([texts for _, texts in self.printed])
+        self.printed.clear()
+        # A stable sort keeps each lane's prints in order
+        order = np.argsort(lanes, kind="stable")
+        lanes = lanes[order]
+        texts = texts[order]
+        starts = np.flatnonzero(lanes[1:] != lanes[:-1]) + 1
+        for lane, chunk in zip(lanes[np.r_[0, starts]].tolist(), np.split(texts, starts)):
+            self.output[lane] += b"".join(chunk)
+
+    def push(self, lanes, values):
+        index = lanes * 8 + SP
+        # Registers are uint8, so SP wraps by itself
+        sp = self.flat_register[index] - 1
+        self.flat_register[index] = sp
+        self.flat_ram[lanes * 256 + sp] = values
+
+    def pop(self, lanes):
+        index = lanes * 8 + SP
+        sp = self.flat_register[index]
+        self.flat_register[index] = sp + 1
+        return self.flat_ram[lanes * 256 + sp]
+
+    def deliver_interrupts(self):
+        '''
+        Take pending interrupts on lanes that have them enabled, as
+        CPU.handle_interrupt() does.
+        '''
+        status = self.register[:, IS]
+        if not status.any():
+            return
+        masked = self.register[:, IM] & status
+        lanes = np.flatnonzero(self.running & self.interrupts_enabled & (masked != 0))
+        if not lanes.size:
+            return
+        # Lowest set bit of IM & IS, and its number
+        masked = masked[lanes].astype(np.intp)
+        bit = masked & -masked
+        number = LOWEST_BIT[bit]
+
+        self.interrupts_enabled[lanes] = False
+        self.register[lanes, IS] &= (~bit & 0xFF).astype(np.uint8)
+        self.push(lanes, self.pc[lanes])
+        self.push(lanes, self.FL[lanes])
+        for i in range(7):
+            self.push(lanes, self.register[lanes, i])
+        self.pc[lanes] = self.ram[lanes, 0xF8 + number]
+
+    def step(self):
+        '''
+        Run one instruction on every running lane.
+
+        Operands are fetched for all lanes at once, then lanes are sorted by
+        opcode and each opcode's handler runs on its run of lanes.
+        '''
+        self.deliver_interrupts()
+        if self.lanes is None:
+            self.lanes = np.flatnonzero(self.running)
+            self.base = self.lanes * 256
+        lanes = self.lanes
+        if not lanes.size:
+            return
+        self.steps += 1
+
+        # PC is uint8, so PC arithmetic wraps by itself
+        pc = self.pc[lanes]
+        base = self.base
+        opcodes = self.flat_ram[base + pc]
+        operand_a = self.flat_ram[base + (pc + 1)]
+        operand_b = self.flat_ram[base + (pc + 2)]
+        if pc.max() >= KEY_ADDRESS - 2:
+            self.fetch_under_key(lanes, pc, (opcodes, operand_a, operand_b))
+        # Move past every instruction up front; jumps overwrite PC
+        self.pc[lanes] = pc + ADVANCE[opcodes]
+
+        first = opcodes[0]
+        if first == opcodes[-1] and (opcodes == first).all():
+            self.dispatch(int(first), lanes, operand_a, operand_b, pc)
+        else:
+            # Sorted by opcode, every group is a slice
+            order = np.argsort(opcodes, kind="stable")
+            opcodes = opcodes[order]
+            lanes, operand_a, operand_b, pc = lanes[order], operand_a[order], operand_b[order], pc[order]
+            bounds = [0] + (np.flatnonzero(opcodes[1:] != opcodes[:-1]) + 1).tolist() + [len(order)]
+            for start, end in zip(bounds, bounds[1:]):
+                self.dispatch(int(opcodes[start]), lanes[start:end], operand_a[start:end],
+                              operand_b[start:end], pc[start:end])
+
+        if self.virtual_timer is not None and self.steps % self.virtual_timer == 0:
+            self.register[self.running, IS] |= 1
+
+    def fetch_under_key(self, lanes, pc, fetched):
+        '''
+        Replace the bytes in fetched (opcodes, then operands) that lanes read
+        from the keyboard register with the RAM bytes under it, which are
+        what CPU fetches.
+        '''
+        for offset, values in enumerate(fetched):
+            at = pc + offset == KEY_ADDRESS
+            values[at] = self.under_key[lanes[at]]
+
+    def dispatch(self, IR, lanes, a, b, pc):
+        '''
+        Run the handler for opcode IR on lanes. Lanes where CPU finds the
+        instruction invalid, an unknown opcode, operands past the end of RAM
+        or a register past R7, are stopped with the same error instead.
+        '''
+        handler = self.branchtable.get(IR)
+        last = 255 - (IR >> 6)
+        first_limit = FIRST_OPERAND_LIMIT[IR]
+        second_limit = SECOND_OPERAND_LIMIT[IR]
+        if (handler is None or pc.max() > last
+                or a.max() > first_limit or b.max() > second_limit):
+            bad = (pc > last) | (a > first_limit) | (b > second_limit)
+            if handler is None:
+                bad[:] = True
+            for lane, at in zip(lanes[bad].tolist(), pc[bad].tolist()):
+                self.fail(lane, at, self.error(lane, at))
+            if bad.all():
+                return
+            good = ~bad
+            lanes, a, b, pc = lanes[good], a[good], b[good], pc[good]
+        handler(IR, lanes, a, b, pc)
+
+    def error(self, lane, pc):
+        '''
+        The message CPU gives for the invalid instruction at pc on lane.
+        '''
+        ram = bytearray(self.ram[lane])
+        ram[KEY_ADDRESS] = self.under_key[lane]
+        try:
+            check_instruction(ram, pc)
+            raise InvalidInstruction(ram[pc], pc)
+        except InvalidInstruction as e:
+            return f"{type(e).__name__}: {e}"
+
+    def run(self, max_cycles=None):
+        '''
+        Step until every lane has stopped, or for at most max_cycles steps.
+        Lanes still running at the end are retired with reason "cycles".
+        '''
+        while self.running.any():
+            if max_cycles is not None and self.steps >= max_cycles:
+                self.retire(np.flatnonzero(self.running), "cycles")
+                break
+            self.step()
+        self.flush()
+
+    # Handlers run one opcode on a group of lanes. They get the opcode, the
+    # lane indices, both operand bytes and each lane's PC. PC has already
+    # been moved past instructions that don't set it.
+
+    def handle_LDI(self, IR, lanes, a, b, pc):
+        self.flat_register[lanes * 8 + a] = b
+
+    def handle_LD(self, IR, lanes, a, b, pc):
+        registers = lanes * 8
+        address = self.flat_register[registers + b]
+        self.flat_register[registers + a] = self.flat_ram[lanes * 256 + address]
+
+    def handle_ST(self, IR, lanes, a, b, pc):
+        registers = lanes * 8
+        address = self.flat_register[registers + a]
+        self.flat_ram[lanes * 256 + address] = self.flat_register[registers + b]
+
+    def handle_PUSH(self, IR, lanes, a, b, pc):
+        # SP moves before the register is read, so PUSH R7 matches
+        # CPU.handle_PUSH
+        registers = lanes * 8
+        sp = self.flat_register[registers + SP] - 1
+        self.flat_register[registers + SP] = sp
+        self.flat_ram[lanes * 256 + sp] = self.flat_register[registers + a]
+
+    def handle_POP(self, IR, lanes, a, b, pc):
+        # SP is bumped after the write, so POP R7 matches CPU.handle_POP
+        registers = lanes * 8
+        self.flat_register[registers + a] = self.flat_ram[lanes * 256 + self.flat_register[registers + SP]]
+        self.flat_register[registers + SP] += 1
+
+    def handle_PRN(self, IR, lanes, a, b, pc):
+        self.print(lanes, PRN_TEXT[self.flat_register[lanes * 8 + a]])
+
+    def handle_PRA(self, IR, lanes, a, b, pc):
+        values = self.flat_register[lanes * 8 + a]
+        self.print(lanes, PRA_TEXT[self.interrupts_enabled[lanes].astype(np.intp), values])
+
+    def handle_alu(self, IR, lanes, a, b, pc):
+        registers = lanes * 8
+        x = self.flat_register[registers + a].astype(np.intp)
+        y = self.flat_register[registers + b].astype(np.intp)
+        self.flat_register[registers + a] = ALU_OPERATIONS[IR](x, y)
+
+    def handle_INC(self, IR, lanes, a, b, pc):
+        self.flat_register[lanes * 8 + a] += 1
+
+    def handle_DEC(self, IR, lanes, a, b, pc):
+        self.flat_register[lanes * 8 + a] -= 1
+
+    def handle_NOT(self, IR, lanes, a, b, pc):
+        self.flat_register[lanes * 8 + a] ^= 0xFF
+
+    def handle_DIV(self, IR, lanes, a, b, pc):
+        self.divide(lanes, a, b, pc, np.floor_divide)
+
+    def handle_MOD(self, IR, lanes, a, b, pc):
+        self.divide(lanes, a, b, pc, np.remainder)
+
+    def divide(self, lanes, a, b, pc, operation):
+        y = self.flat_register[lanes * 8 + b].astype(np.intp)
+        zero = y == 0
+        if zero.any():
+            texts = [b"Error: division by zero at address %02X\n" % at for at in pc[zero].tolist()]
+            self.print(lanes[zero], np.array(texts, dtype=object))
+            self.retire(lanes[zero], "halt")
+            lanes, a, y = lanes[~zero], a[~zero], y[~zero]
+        index = lanes * 8 + a
+        self.flat_register[index] = operation(self.flat_register[index].astype(np.intp), y)
+
+    def handle_CMP(self, IR, lanes, a, b, pc):
+        registers = lanes * 8
+        x = self.flat_register[registers + a]
+        y = self.flat_register[registers + b]
+        self.FL[lanes] = np.where(x < y, 0b100, np.where(x > y, 0b010, 0b001))
+
+    def handle_CALL(self, IR, lanes, a, b, pc):
+        # The target is read after the push, as in CPU.handle_CALL
+        self.push(lanes, pc + 2)
+        self.pc[lanes] = self.flat_register[lanes * 8 + a]
+
+    def handle_RET(self, IR, lanes, a, b, pc):
+        self.pc[lanes] = self.pop(lanes)
+
+    def handle_INT(self, IR, lanes, a, b, pc):
+        self.register[lanes, IS] |= (1 << (self.flat_register[lanes * 8 + a] & 0b111)).astype(np.uint8)
+        self.pc[lanes] = pc + 2
+
+    def handle_IRET(self, IR, lanes, a, b, pc):
+        for i in range(6, -1, -1):
+            self.register[lanes, i] = self.pop(lanes)
+        self.FL[lanes] = self.pop(lanes)
+        self.pc[lanes] = self.pop(lanes)
+        self.interrupts_enabled[lanes] = True
+
+    def handle_JMP(self, IR, lanes, a, b, pc):
+        self.pc[lanes] = self.flat_register[lanes * 8 + a]
+
+    def handle_jump_if(self, IR, lanes, a, b, pc):
+        self.jump(lanes, a, pc, (self.FL[lanes] & CONDITIONS[IR]) != 0)
+
+    def handle_JNE(self, IR, lanes, a, b, pc):
+        self.jump(lanes, a, pc, (self.FL[lanes] & 0b00000001) == 0)
+
+    def jump(self, lanes, a, pc, taken):
+        target = self.flat_register[lanes * 8 + a]
+        self.pc[lanes] = np.where(taken, target, pc + 2)
+
+    def handle_HLT(self, IR, lanes, a, b, pc):
+        self.retire(lanes, "halt")
+
+    def handle_NOP(self, IR, lanes, a, b, pc):
+        self.print(lanes, np.full(len(lanes), b"THIS IS NOP. EXITING PROGRAM\n", dtype=object))
+        self.retire(lanes, "halt")
+
+
+def crosscheck(paths, max_cycles, virtual_timer=None):
+    '''
+    Run every program on both CPU engines and in one Lockstep, and return a
+    line for each program whose output, stop reason or cycle count differs.
+    '''
+    from batch import run_program
+
+    programs = [image.read_program(path) for path in paths]
+    machines = Lockstep(programs, virtual_timer)
+    machines.run(max_cycles)
+
+    mismatches = []
+    for lane, path in enumerate(paths):
+        reason = machines.reasons[lane]
+        output = bytes(machines.output[lane])
+        for engine in ("interpreter", "translate"):
+            expected = run_program(path, max_cycles, None, engine=engine,
+                                   virtual_timer=virtual_timer)
+            if expected.reason != reason:
+                mismatches.append(f"{path}: stopped with {reason}, CPU ({engine}) "
+                                  f"stopped with {expected.reason}")
+            elif expected.output != output:
+                mismatches.append(f"{path}: output differs from CPU ({engine})")
+            elif expected.cycles != machines.cycles[lane]:
+                mismatches.append(f"{path}: {machines.cycles[lane]} cycles, "
+                                  f"CPU ({engine}) ran {expected.cycles}")
+    return mismatches
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Run LS-8 programs in lockstep with NumPy.")
+    parser.add_argument("paths", nargs="+", help="programs to run, one lane each")
+    parser.add_argument("--lanes", type=int, default=1,
+                        help="run each program on this many lanes")
+    parser.add_argument("--max-cycles", type=int, default=100000,
+                        help="instruction budget per lane")
+    parser.add_argument("--virtual-timer", type=int, default=None,
+                        help="fire the timer every N instructions")
+    parser.add_argument("--check", action="store_true",
+                        help="compare every program's result against both CPU engines")
+    args = parser.parse_args(argv[1:])
+
+    if args.check:
+        mismatches = crosscheck(args.paths, args.max_cycles, args.virtual_timer)
+        for line in mismatches:
+            print(f"MISMATCH {line}", file=sys.stderr)
+        print(f"{len(args.paths)} programs checked, {len(mismatches)} mismatches")
+        return 1 if mismatches else 0
+
+    programs = [image.read_program(path) for path in args.paths for _ in range(args.lanes)]
+    machines = Lockstep(programs, args.virtual_timer)
+    machines.run(args.max_cycles)
+    for lane, program in enumerate(programs):
+        path = args.paths[lane // args.lanes]
+        print(f"{path:40} {machines.reasons[lane]:8} {machines.cycles[lane]:12,} cycles "
+              f"{machines.errors[lane] or ''}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
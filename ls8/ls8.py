@@ -2,10 +2,86 @@
 
 """Main."""
 
+import signal
 import sys
 from cpu import *
+from devices import Banks, Keyboard, Timer
 
-cpu = CPU()
+# Usage: ls8.py program.ls8 [--translate] [--keyboard] [--input keys.txt] [--virtual-timer N]
+#                           [--memory N] [--profile N] [--flamegraph out.folded]
+#                           [--trace N] [--trace-file ls8.trace] [--break addresses]
+options = sys.argv[2:]
+
+engine = "translate" if "--translate" in options else "interpreter"
+
+if "--input" in options:
+    # Scripted key presses from a file (or "-" for stdin)
+    path = options[options.index("--input") + 1]
+    keyboard = Keyboard(sys.stdin if path == "-" else open(path, "rb"))
+else:
+    keyboard = Keyboard()
+
+if "--virtual-timer" in options:
+    # Fire the timer every N instructions instead of every second
+    timer = Timer(instructions=int(options[options.index("--virtual-timer") + 1]))
+else:
+    timer = Timer()
+
+banks = None
+if "--memory" in options:
+    # N bytes of extended memory, banked through 0x80-0xBF
+    banks = Banks(int(options[options.index("--memory") + 1], 0))
+
+cpu = CPU(engine, keyboard, timer, banks=banks)
+
+# Exit cleanly on SIGTERM so buffered output is flushed
+signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
 
 cpu.load()
-cpu.run()
\ No newline at end of file
+
+# Without --input, keys are read from stdin with --keyboard or when the
+# program looks like it uses the keyboard. The reader thread puts a TTY in
+# cbreak mode, and output is flushed after every slice while it runs.
+if "--input" not in options and ("--keyboard" in options or uses_keyboard(cpu.ram)):
+    keyboard.start(sys.stdin)
+
+if "--trace" in options:
+    # Keep the last N instructions; dumped on HLT, on a crash or on SIGUSR1.
+    # Render the dump with tracer.py.
+    from tracer import Tracer
+    path = "ls8.trace"
+    if "--trace-file" in options:
+        path = options[options.index("--trace-file") + 1]
+    tracer = Tracer(cpu, int(options[options.index("--trace") + 1]), path)
+    signal.signal(signal.SIGUSR1, lambda signum, frame: tracer.dump())
+
+if "--break" in options:
+    # Print the CPU state with trace() whenever PC reaches one of these
+    # comma-separated addresses, e.g. --break 0x0A,0x1F
+    from debugger import Debugger
+    debugger = Debugger(cpu)
+    for address in options[options.index("--break") + 1].split(","):
+        debugger.set_breakpoint(int(address, 0))
+
+if "--profile" in options:
+    # Profile every Nth instruction; the report goes to stderr at exit
+    from profiler import Profiler
+    profiler = Profiler(cpu, int(options[options.index("--profile") + 1]))
+    try:
+        result = cpu.run()
+    finally:
+        sys.stderr.write(profiler.report())
+        if "--flamegraph" in options:
+            with open(options[options.index("--flamegraph") + 1], "w") as file:
+                file.write(profiler.collapsed())
+else:
+    result = cpu.run()
+    while result.reason == "breakpoint":
+        cpu.trace()
+        result = cpu.run()
+
+if result.reason == "invalid":
+    print(result.error, file=sys.stderr)
+
+# The program halted; HLT has always exited with status 1
+sys.exit(1)
@@ -0,0 +1,167 @@
+"""Instruction-level profiler for the LS-8 CPU."""
+
+import collections
+import time
+
+from cpu import CALL, RET, IRET, MNEMONICS
+
+
+class Profiler:
+    """
+    Collects where an LS-8 program spends its cycles.
+
+    With period=1 every instruction is counted through an instrumented run
+    loop. With a larger period the CPU runs its normal loop and the profiler
+    takes one sample every `period` instructions, weighted by the period, so
+    the overhead is a small fixed cost per sample.
+
+    Both modes record per-opcode counts, per-address hit counts and the
+    stack of calls and interrupts each instruction ran under. Call-graph
+    edges and the time spent inside interrupt handlers are exact in both
+    modes, as they are collected from CALL, RET, IRET and interrupt entry.
+
+    Profiling runs the interpreter loop even on a CPU created with the
+    translate engine, as translated blocks would hide calls and returns.
+    """
+
+    def __init__(self, cpu, period=1, symbols=None):
+        self.cpu = cpu
+        self.period = period
+        # Address -> name, e.g. the symbol table of a binary image
+        self.symbols = symbols or {}
+
+        self.opcodes = [0] * 256
+        self.hits = [0] * 256
+        self.edges = collections.Counter()
+        self.stacks = collections.Counter()
+        self.interrupt_time = collections.Counter()
+        self.interrupt_count = collections.Counter()
+
+        self.stack = ["main"]
+        self.stack_key = "main"
+        # Start times of the interrupt handlers currently running
+        self.interrupt_started = []
+        self.pending = 0
+
+        cpu.profiler = self
+        self.call = cpu.branchtable[CALL]
+        self.ret = cpu.branchtable[RET]
+        self.iret = cpu.branchtable[IRET]
+        cpu.branchtable[CALL] = self.handle_CALL
+        cpu.branchtable[RET] = self.handle_RET
+        cpu.branchtable[IRET] = self.handle_IRET
+
+    def name(self, address):
+        return self.symbols.get(address, f"sub_{address:02X}")
+
+    def push(self, frame):
+        caller = self.stack[-1]
+        self.edges[(caller, frame)] += 1
+        self.stack.append(frame)
+        self.stack_key = ";".join(self.stack)
+
+    def pop(self):
+        # A RET without a matching CALL leaves the root frame in place
+        if len(self.stack) > 1:
+            self.stack.pop()
+            self.stack_key = ";".join(self.stack)
+
+    def handle_CALL(self, reg):
+        self.call(reg)
+        self.push(self.name(self.cpu.pc))
+
+    def handle_RET(self):
+        self.ret()
+        self.pop()
+
+    def handle_IRET(self):
+        self.iret()
+        if self.interrupt_started:
+            vector, started = self.interrupt_started.pop()
+            self.interrupt_time[vector] += time.perf_counter() - started
+        self.pop()
+
+    def enter_interrupt(self, number):
+        '''
+        Called by the CPU when it takes interrupt I<number>.
+        '''
+        vector = f"I{number}"
+        self.interrupt_count[vector] += 1
+        self.interrupt_started.append((vector, time.perf_counter()))
+        self.push(f"interrupt_{vector}")
+
+    def sample(self, retired):
+        '''
+        Called by the CPU after each slice. Only samples in sampling mode; with
+        period=1 run() has already counted every instruction.
+        '''
+        if self.period == 1:
+            return
+        self.pending += retired
+        if self.pending < self.period:
+            return
+        weight = self.pending - self.pending % self.period
+        self.pending -= weight
+
+        cpu = self.cpu
+        self.opcodes[cpu.ram[cpu.pc]] += weight
+        self.hits[cpu.pc] += weight
+        self.stacks[self.stack_key] += weight
+
+    def run(self):
+        '''
+        Run the CPU through its instrumented loop, counting every instruction.
+        '''
+        self.cpu.run_instrumented(before=self.count)
+
+    def count(self, pc):
+        self.opcodes[self.cpu.ram[pc]] += 1
+        self.hits[pc] += 1
+        self.stacks[self.stack_key] += 1
+
+    def report(self, top=20):
+        '''
+        Return a text report of the hottest opcodes, addresses, call edges and
+        interrupt handlers.
+        '''
+        total = sum(self.opcodes) or 1
+        lines = [f"{sum(self.opcodes):,} instructions"
+                 + (f" (sampled every {self.period})" if self.period > 1 else "")]
+
+        lines.append("")
+        lines.append("Opcodes:")
+        ranked = sorted(range(256), key=lambda IR: -self.opcodes[IR])
+        for IR in ranked[:top]:
+            if self.opcodes[IR]:
+                name = MNEMONICS.get(IR, f"{IR:08b}")
+                lines.append(f"  {name:6} {self.opcodes[IR]:12,} {self.opcodes[IR] / total:7.1%}")
+
+        lines.append("")
+        lines.append("Addresses:")
+        ranked = sorted(range(256), key=lambda pc: -self.hits[pc])
+        for pc in ranked[:top]:
+            if self.hits[pc]:
+                name = MNEMONICS.get(self.cpu.ram[pc], "?")
+                lines.append(f"  {pc:02X} {name:6} {self.hits[pc]:12,} {self.hits[pc] / total:7.1%}")
+
+        if self.edges:
+            lines.append("")
+            lines.append("Calls:")
+            for (caller, callee), count in self.edges.most_common(top):
+                lines.append(f"  {caller} -> {callee} {count:,}")
+
+        if self.interrupt_count:
+            lines.append("")
+            lines.append("Interrupt handlers:")
+            for vector, count in sorted(self.interrupt_count.items()):
+                seconds = self.interrupt_time[vector]
+                lines.append(f"  {vector} {count:,} times {seconds * 1000:.3f} ms")
+
+        return "\n".join(lines) + "\n"
+
+    def collapsed(self):
+        '''
+        Return the stacks in the collapsed format used by flamegraph.pl:
+        one "frame;frame;frame count" line per stack.
+        '''
+        return "".join(f"{stack} {count}\n" for stack, count in sorted(self.stacks.items()))
@@ -0,0 +1,54 @@
+"""Wire format spoken between server.py and client.py."""
+
+import os
+import struct
+
+# Where the server listens by default. A fixed path under /tmp rather than
+# tempfile.gettempdir(), which would cost the client importing tempfile.
+SOCKET = os.environ.get("LS8_SOCKET") or "/tmp/ls8-%d.sock" % os.getuid()
+
+# A connection starts with one request: magic, engine (0 interpreter,
+# 1 translate), program length, length of the keys queued before it starts,
+# cycle budget, virtual timer period and wall-clock budget in seconds, each
+# 0 for none. The program follows, as the contents of a .ls8 text file or
+# of a binary image, then the keys.
+REQUEST = struct.Struct("<4sBIIQQd")
+MAGIC = b"LS8R"
+ENGINES = ("interpreter", "translate")
+
+# After that both sides send frames: kind, payload length, payload
+FRAME = struct.Struct("<cI")
+
+# Client to server: more key presses, while the program runs
+KEYS = b"K"
+
+# Server to client: console output, then one result: cycles and PC, then
+# the reason the program stopped, a newline and the error message, if any
+OUTPUT = b"O"
+RESULT = b"R"
+RESULT_HEADER = struct.Struct("<QB")
+
+
+def frame(kind, payload=b""):
+    '''
+    Encode one frame.
+    '''
+    return FRAME.pack(kind, len(payload)) + payload
+
+
+def result(reason, cycles, pc, error=None):
+    '''
+    Encode a result frame.
+    '''
+    return frame(RESULT, RESULT_HEADER.pack(cycles, pc)
+                 + f"{reason}\n{error or ''}".encode())
+
+
+def parse_result(payload):
+    '''
+    Decode a result frame's payload into (reason, cycles, pc, error), where
+    error is None if there was none.
+    '''
+    cycles, pc = RESULT_HEADER.unpack_from(payload)
+    reason, _, error = payload[RESULT_HEADER.size:].decode().partition("\n")
+    return reason, cycles, pc, error or None
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+
+"""
+Warm LS-8 emulator server.
+
+Keeps a pool of ready CPUs in one asyncio process and runs the programs
+sent to it over a Unix domain socket, streaming their console output back
+as they run. client.py is a drop-in replacement for `python ls8.py` that
+talks to it, so short programs skip Python startup entirely:
+
+    python server.py &
+    python client.py examples/print8.ls8
+"""
+
+import argparse
+import asyncio
+import functools
+import os
+import signal
+import sys
+import time
+
+import image
+import protocol
+from cpu import CPU, HLT
+from devices import Console, Keyboard, Timer
+
+# Instructions run between two returns to the event loop, so a long program
+# doesn't hold up the others and its output is sent while it runs
+SLICE = 10000
+
+# Parsed programs kept in memory, keyed by the bytes sent
+PROGRAM_CACHE = 256
+
+
+@functools.lru_cache(maxsize=PROGRAM_CACHE)
+def parse(data):
+    '''
+    Program bytes for a request's program.
+    '''
+    return image.program_bytes(data, cache=False)
+
+
+class Server:
+    """
+    Runs requests on CPUs taken from a per-engine pool.
+
+    A CPU is reset from a snapshot of a fresh one before each program, so
+    its decode table and instruction cache are built once and reused.
+    max_cycles and timeout cap what any one request may ask for.
+    """
+
+    def __init__(self, size=8, max_cycles=None, timeout=None):
+        self.size = size
+        self.max_cycles = max_cycles
+        self.timeout = timeout
+        self.blank = CPU(console=Console(bytearray())).snapshot()
+        self.pools = {engine: [self.new_cpu(engine) for _ in range(size)]
+                      for engine in protocol.ENGINES}
+
+    def new_cpu(self, engine):
+        '''
+        Build a CPU and run it once, so everything it builds lazily exists.
+        '''
+        cpu = CPU(engine, console=Console(bytearray()))
+        # Idle programs wait on the event loop, not in the CPU
+        cpu.idle_sleep = False
+        cpu.ram[0] = HLT
+        cpu.run()
+        return cpu
+
+    def acquire(self, engine):
+        pool = self.pools[engine]
+        return pool.pop() if pool else self.new_cpu(engine)
+
+    def release(self, cpu):
+        pool = self.pools[cpu.engine]
+        if len(pool) < self.size:
+            pool.append(cpu)
+
+    def limit(self, requested, cap):
+        '''
+        A request's budget (0 for none) combined with the server's cap.
+        '''
+        if not requested:
+            return cap
+        if cap is None:
+            return requested
+        return min(requested, cap)
+
+    async def handle(self, reader, writer):
+        '''
+        Serve one connection: read the request, run it and send the result.
+        '''
+        try:
+            header = await reader.readexactly(protocol.REQUEST.size)
+            (magic, engine, length, key_count,
+             max_cycles, virtual_timer, timeout) = protocol.REQUEST.unpack(header)
+            if magic != protocol.MAGIC or engine >= len(protocol.ENGINES):
+                return
+            data = await reader.readexactly(length)
+            keys = await reader.readexactly(key_count)
+
+            result = await self.execute(
+                reader, writer, protocol.ENGINES[engine], data, keys,
+                self.limit(max_cycles, self.max_cycles),
+                virtual_timer or None,
+                self.limit(timeout, self.timeout))
+            if result is not None:
+                writer.write(protocol.result(*result))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def read_keys(self, reader, keyboard, arrived):
+        '''
+        Queue key frames from the client until it disconnects, setting
+        arrived for each.
+        '''
+        try:
+            while True:
+                kind, length = protocol.FRAME.unpack(await reader.readexactly(protocol.FRAME.size))
+                payload = await reader.readexactly(length)
+                if kind == protocol.KEYS:
+                    keyboard.keys.extend(payload)
+                    arrived.set()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+
+    async def idle(self, cpu, arrived, more_keys, stop_at):
+        '''
+        Wait, letting other requests run, until an idle program's timer is
+        due, a key arrives, the client goes away or the timeout passes.
+        '''
+        end = cpu.timer.deadline if stop_at is None else min(cpu.timer.deadline, stop_at)
+        arrived.clear()
+        waiter = asyncio.ensure_future(arrived.wait())
+        await asyncio.wait({waiter, more_keys}, timeout=max(0, end - time.monotonic()),
+                           return_when=asyncio.FIRST_COMPLETED)
+        waiter.cancel()
+
+    async def execute(self, reader, writer, engine, data, keys, max_cycles, virtual_timer, timeout):
+        '''
+        Run one program in slices of SLICE instructions and return its result
+        as (reason, cycles, pc, error), or None if the client went away.
+        '''
+        cpu = self.acquire(engine)
+        more_keys = None
+        try:
+            cpu.restore(self.blank)
+            cpu.keyboard = Keyboard(keys)
+            cpu.keyboard.attach(cpu)
+            cpu.timer = Timer(instructions=virtual_timer)
+            cpu.timer_started = False
+            cpu.console = Console(lambda output: writer.write(protocol.frame(protocol.OUTPUT, output)))
+            arrived = asyncio.Event()
+            more_keys = asyncio.ensure_future(self.read_keys(reader, cpu.keyboard, arrived))
+
+            stop_at = None if timeout is None else time.monotonic() + timeout
+            reason = error = None
+            try:
+                cpu.load_bytes(parse(data))
+                while reason is None:
+                    count = SLICE
+                    if max_cycles is not None:
+                        count = min(count, max_cycles - cpu.cycles)
+                    result = cpu.run(count)
+                    if result.reason not in ("cycles", "idle"):
+                        reason = result.reason
+                        if result.error is not None:
+                            error = f"{type(result.error).__name__}: {result.error}"
+                    elif max_cycles is not None and cpu.cycles >= max_cycles:
+                        reason = "cycles"
+                    elif stop_at is not None and time.monotonic() >= stop_at:
+                        reason = "timeout"
+                    else:
+                        # Send what was printed and let other requests run
+                        await writer.drain()
+                        if result.reason == "idle":
+                            await self.idle(cpu, arrived, more_keys, stop_at)
+                        else:
+                            await asyncio.sleep(0)
+                        if more_keys.done():
+                            return None
+            except Exception as e:
+                reason = "error"
+                error = f"{type(e).__name__}: {e}"
+            return reason, cpu.cycles, cpu.pc, error
+        finally:
+            if more_keys is not None:
+                more_keys.cancel()
+            self.release(cpu)
+
+
+async def serve(path, server):
+    '''
+    Listen on the Unix socket at path until SIGINT or SIGTERM.
+    '''
+    if os.path.exists(path):
+        os.unlink(path)
+    listener = await asyncio.start_unix_server(server.handle, path)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+    try:
+        await stop.wait()
+    finally:
+        listener.close()
+        await listener.wait_closed()
+        os.unlink(path)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Serve LS-8 programs over a Unix socket.")
+    parser.add_argument("--socket", default=protocol.SOCKET,
+                        help=f"socket path (default: {protocol.SOCKET})")
+    parser.add_argument("--cpus", type=int, default=8,
+                        help="CPUs kept ready per engine")
+    parser.add_argument("--max-cycles", type=int, default=None,
+                        help="most instructions any one program may run")
+    parser.add_argument("--timeout", type=float, default=None,
+                        help="most seconds any one program may run")
+    args = parser.parse_args(argv[1:])
+
+    server = Server(args.cpus, args.max_cycles, args.timeout)
+    print(f"Listening on {args.socket}", file=sys.stderr)
+    asyncio.run(serve(args.socket, server))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,22 @@
+"""Terminal setup shared by the keyboard device and client.py."""
+
+import atexit
+import os
+
+try:
+    import termios
+    import tty
+except ImportError:  # Not available on Windows
+    termios = None
+    tty = None
+
+
+def cbreak(fd):
+    '''
+    If fd is a TTY, switch it to cbreak mode so keys arrive unbuffered while
+    Ctrl-C still works. The old settings are restored at exit.
+    '''
+    if termios is not None and os.isatty(fd):
+        settings = termios.tcgetattr(fd)
+        tty.setcbreak(fd)
+        atexit.register(termios.tcsetattr, fd, termios.TCSADRAIN, settings)
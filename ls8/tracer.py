@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+"""Binary ring-buffer execution trace for the LS-8 CPU."""
+
+import struct
+import sys
+
+from cpu import Stop
+
+# One record per instruction, taken before it runs:
+# PC, opcode, the two bytes after it, FL, then R0-R7
+RECORD = struct.Struct("<5B8s")
+
+# Trace file: magic, record size, record count, then the records oldest first
+HEADER = struct.Struct("<4sHI")
+MAGIC = b"LS8T"
+
+
+class Tracer:
+    """
+    Records the last `depth` instructions in a preallocated ring buffer.
+
+    Memory use is depth * RECORD.size bytes however long the program runs.
+    The buffer is written to `path` when the program halts or crashes, and
+    can be written at any time with dump().
+    """
+
+    def __init__(self, cpu, depth=65536, path=None):
+        self.cpu = cpu
+        self.depth = depth
+        self.path = path
+        self.buffer = bytearray(depth * RECORD.size)
+        # Total number of records written; the ring holds the last depth
+        self.count = 0
+        cpu.tracer = self
+
+    def records(self):
+        '''
+        Return the buffered records, oldest first, as one bytes object.
+        '''
+        if self.count <= self.depth:
+            return bytes(self.buffer[:self.count * RECORD.size])
+        split = (self.count % self.depth) * RECORD.size
+        return bytes(self.buffer[split:] + self.buffer[:split])
+
+    def dump(self, path=None):
+        '''
+        Write the trace to path (or the tracer's own path).
+        '''
+        records = self.records()
+        with open(path or self.path, "wb") as file:
+            file.write(HEADER.pack(MAGIC, RECORD.size, len(records) // RECORD.size))
+            file.write(records)
+
+    def run(self):
+        '''
+        Run the CPU through its instrumented loop, recording every
+        instruction before it runs. The trace is dumped when the program
+        halts or raises, but not when run() stops it at one of its limits.
+        '''
+        try:
+            self.cpu.run_instrumented(before=self.record)
+        except Stop:
+            raise
+        except BaseException:
+            if self.path is not None:
+                self.dump()
+            raise
+
+    def record(self, pc):
+        '''
+        Write the record for the instruction at pc into the ring.
+        '''
+        cpu = self.cpu
+        ram = cpu.ram
+        offset = (self.count % self.depth) * RECORD.size
+        RECORD.pack_into(self.buffer, offset, pc, ram[pc], ram[(pc + 1) & 0xFF],
+                         ram[(pc + 2) & 0xFF], cpu.FL, bytes(cpu.register))
+        self.count += 1
+
+
+def decode(data):
+    '''
+    Render a trace file's contents as TRACE lines in the format of
+    CPU.trace().
+    '''
+    magic, size, count = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError("Not an LS-8 trace")
+    lines = []
+    for offset in range(HEADER.size, HEADER.size + size * count, size):
+        pc, IR, operand_a, operand_b, FL, registers = RECORD.unpack_from(data, offset)
+        line = "TRACE: %02X | %02X %02X %02X |" % (pc, IR, operand_a, operand_b)
+        line += "".join(" %02X" % r for r in registers)
+        lines.append(line)
+    return lines
+
+
+def main(argv):
+    if len(argv) != 2:
+        print("usage: tracer.py file.trace", file=sys.stderr)
+        return 1
+    with open(argv[1], "rb") as file:
+        for line in decode(file.read()):
+            print(line)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,268 @@
+"""Basic-block translator for the LS-8 CPU."""
+
+from cpu import (
+    LDI, ADD, SUB, MUL, INC, DEC, CMP, AND, NOT, OR, XOR, SHL, SHR,
+    PRN, PRA, PUSH, POP, ST,
+    JMP, JEQ, JNE, JGT, JLT, JLE, JGE, CALL, RET,
+    WAKE_INTERRUPTS, Idle,
+)
+
+# Registers that affect interrupt delivery. A block ends right after an
+# instruction that writes one of them, recomputing cpu.interrupt_pending, so
+# the run loop can check for interrupts at exactly the same point the
+# interpreter would.
+INTERRUPT_REGISTERS = (5, 6)
+
+# Longest run of instructions translated into a single block
+MAX_BLOCK_LENGTH = 64
+
+# Two-register ALU ops and the expression for the new value of registerA.
+# DIV and MOD stay in the interpreter, which halts on a zero divisor.
+ALU_EXPRESSIONS = {
+    ADD: "(reg[{a}] + reg[{b}]) & 0xFF",
+    SUB: "(reg[{a}] - reg[{b}]) & 0xFF",
+    MUL: "(reg[{a}] * reg[{b}]) & 0xFF",
+    AND: "reg[{a}] & reg[{b}]",
+    OR: "reg[{a}] | reg[{b}]",
+    XOR: "reg[{a}] ^ reg[{b}]",
+    SHL: "(reg[{a}] << reg[{b}]) & 0xFF",
+    SHR: "reg[{a}] >> reg[{b}]",
+}
+
+
+# When each conditional jump is taken
+CONDITIONS = {
+    JEQ: "cpu.FL & 0b00000001",
+    JNE: "not cpu.FL & 0b00000001",
+    JGT: "cpu.FL & 0b00000010",
+    JLT: "cpu.FL & 0b00000100",
+    JLE: "cpu.FL & 0b00000101",
+    JGE: "cpu.FL & 0b00000011",
+}
+
+
+def idle_check(ir, a, pc):
+    '''
+    Lines for a jump that starts its block: raise Idle if it jumps to
+    itself while an interrupt can wake the program, as CPU.idle_JMP does.
+    '''
+    condition = f"reg[{a}] == {pc} and cpu.interrupts_enabled and reg[5] & {WAKE_INTERRUPTS}"
+    if ir != JMP:
+        condition = f"({CONDITIONS[ir]}) and {condition}"
+    return [f"if {condition}:", "    raise Idle()"]
+
+
+def write_register(a, lines):
+    '''
+    Lines for an instruction that writes register a, followed by a refresh
+    of the pending-interrupt flag if a is IM or IS.
+    '''
+    if a in INTERRUPT_REGISTERS:
+        return lines + ["cpu.update_interrupts()"]
+    return lines
+
+
+def store(address, value):
+    '''
+    Lines that store value at address, the way CPU.ram_write does, with
+    stores to mapped devices going through ram_write itself.
+    '''
+    return [
+        f"if writes[{address}]:",
+        f"    cpu.ram_write({value}, {address})",
+        "else:",
+        f"    ram[{address}] = {value}",
+        f"    dirty[{address} >> 4] = 1",
+        f"    if cover[{address}]:",
+        f"        invalidate({address})",
+        f"    if decoded[{address}]:",
+        f"        cpu.forget({address})",
+    ]
+
+
+class BlockTranslator:
+    """
+    Translates straight-line runs of LS-8 instructions into Python functions.
+
+    A block starts at a PC and runs until a jump, a call, a return, a store, a
+    push or an instruction the translator doesn't know how to inline. Each block is
+    compiled once and cached by its entry address. Any write into an address
+    covered by a translated block throws that block away.
+    """
+
+    def __init__(self, cpu):
+        self.cpu = cpu
+        self.blocks = {}
+        # For every RAM address, the entry addresses of the blocks covering it
+        self.cover = [[] for _ in range(len(cpu.ram))]
+
+    def lookup(self, pc):
+        '''
+        Return the compiled block starting at pc, or None if the instruction at
+        pc has to go through the interpreter.
+        '''
+        try:
+            return self.blocks[pc]
+        except KeyError:
+            block = self.translate(pc)
+            self.blocks[pc] = block
+            return block
+
+    def reset(self):
+        '''
+        Drop every block, for when RAM is replaced wholesale.
+        '''
+        self.blocks.clear()
+        for entries in self.cover:
+            entries.clear()
+
+    def invalidate(self, address):
+        '''
+        Drop every block that contains the given RAM address.
+        '''
+        for entry in self.cover[address][:]:
+            block = self.blocks.pop(entry, None)
+            length = getattr(block, "length", 1)
+            for a in range(entry, entry + length):
+                if entry in self.cover[a]:
+                    self.cover[a].remove(entry)
+
+    def translate(self, entry):
+        '''
+        Decode instructions starting at entry and compile them into a block.
+        '''
+        ram = self.cpu.ram
+        lines = []
+        pc = entry
+        count = 0
+
+        while count < MAX_BLOCK_LENGTH:
+            # Leave the last bytes of RAM, where PC wraps, to the interpreter
+            if pc + 3 >= len(ram):
+                break
+            ir = ram[pc]
+            a = ram[pc + 1]
+            b = ram[pc + 2]
+            emitted = self.emit(ir, a, b, pc)
+            if emitted is None:
+                break
+            body, size, ends = emitted
+            if count == 0 and (ir == JMP or ir in CONDITIONS):
+                # A block made of a jump to itself is an idle loop
+                lines.extend(idle_check(ir, a, pc))
+            lines.extend(body)
+            pc += size
+            count += 1
+            if ends:
+                break
+
+        if count == 0:
+            # Remember that this address runs through the interpreter
+            self.cover[entry].append(entry)
+            return None
+
+        if not lines[-1].startswith("return"):
+            lines.append(f"return {pc}")
+
+        source = "def block(cpu, reg, ram, cover, invalidate, dirty):\n"
+        source += "".join(f"    {line}\n" for line in lines)
+        # The device maps are updated in place, so blocks can hold on to them
+        namespace = {"reads": self.cpu.device_reads, "writes": self.cpu.device_writes,
+                     "decoded": self.cpu.code_cover, "Idle": Idle}
+        exec(compile(source, f"<block {entry:02X}>", "exec"), namespace)
+        block = namespace["block"]
+        block.length = pc - entry
+        # Every block runs to its end, so it always retires this many
+        block.count = count
+        block.source = source
+
+        for address in range(entry, pc):
+            self.cover[address].append(entry)
+
+        return block
+
+    def emit(self, ir, a, b, pc):
+        '''
+        Return (lines, size, ends_block) for one instruction, or None if it
+        can't be translated.
+        '''
+        # Register operands past R7 are left to the interpreter, which
+        # raises at that instruction rather than part way through a block
+        size = (ir >> 6) + 1
+        if (size >= 2 and a > 7) or (size == 3 and ir != LDI and b > 7):
+            return None
+        if ir == LDI:
+            return write_register(a, [f"reg[{a}] = {b}"]), 3, a in INTERRUPT_REGISTERS
+        if ir in ALU_EXPRESSIONS:
+            expression = ALU_EXPRESSIONS[ir].format(a=a, b=b)
+            return write_register(a, [f"reg[{a}] = {expression}"]), 3, a in INTERRUPT_REGISTERS
+        if ir == NOT:
+            return write_register(a, [f"reg[{a}] ^= 0xFF"]), 2, a in INTERRUPT_REGISTERS
+        if ir == INC:
+            return write_register(a, [f"reg[{a}] = (reg[{a}] + 1) & 0xFF"]), 2, a in INTERRUPT_REGISTERS
+        if ir == DEC:
+            return write_register(a, [f"reg[{a}] = (reg[{a}] - 1) & 0xFF"]), 2, a in INTERRUPT_REGISTERS
+        if ir == CMP:
+            return [
+                f"x = reg[{a}]",
+                f"y = reg[{b}]",
+                "if x < y:",
+                "    cpu.FL = 0b00000100",
+                "elif x == y:",
+                "    cpu.FL = 0b00000001",
+                "elif x > y:",
+                "    cpu.FL = 0b00000010",
+            ], 3, False
+        if ir == PRN:
+            return [f"cpu.console.write(b'%d\\n' % reg[{a}])"], 2, False
+        if ir == PRA:
+            return [
+                "if cpu.interrupts_enabled == False:",
+                f"    cpu.console.write((chr(reg[{a}]) + '\\n').encode())",
+                "else:",
+                f"    cpu.console.write(chr(reg[{a}]).encode())",
+            ], 2, False
+        if ir == PUSH:
+            return [
+                "sp = (reg[7] - 1) & 0xFF",
+                "reg[7] = sp",
+            ] + store("sp", f"reg[{a}]") + [
+                f"return {pc + 2}",
+            ], 2, True
+        if ir == POP:
+            return write_register(a, [
+                "sp = reg[7]",
+                "value = cpu.ram_read(sp) if reads[sp] else ram[sp]",
+                f"reg[{a}] = value",
+                # After the write, so POP R7 matches the interpreter
+                "reg[7] = (reg[7] + 1) & 0xFF",
+            ]), 2, a in INTERRUPT_REGISTERS
+        if ir == ST:
+            return [
+                f"address = reg[{a}]",
+            ] + store("address", f"reg[{b}]") + [
+                f"return {pc + 3}",
+            ], 3, True
+        if ir == JMP:
+            return [f"return reg[{a}]"], 2, True
+        if ir in CONDITIONS:
+            return [
+                f"if {CONDITIONS[ir]}:",
+                f"    return reg[{a}]",
+                f"return {(pc + 2) & 0xFF}",
+            ], 2, True
+        if ir == CALL:
+            return [
+                "sp = (reg[7] - 1) & 0xFF",
+                "reg[7] = sp",
+                f"target = reg[{a}]",
+            ] + store("sp", (pc + 2) & 0xFF) + [
+                "return target",
+            ], 2, True
+        if ir == RET:
+            return [
+                "sp = reg[7]",
+                "reg[7] = (sp + 1) & 0xFF",
+                "return cpu.ram_read(sp) if reads[sp] else ram[sp]",
+            ], 1, True
+        return None